@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+###############################################################################
+# Filename: benchmark.py
+#
+# This file builds synthetic download, archive and purge trees and times every
+# phase of a sweep over them, so that runs can be compared for regressions.
+###############################################################################
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import download_sweeper
+from download_sweeper import ConfigKeyTranslator
+
+DAY = 24 * 60 * 60
+FILE_CONTENTS = b"download-sweeper benchmark payload\n"
+
+
+def peak_rss_bytes():
+    """ Returns the peak resident set size of this process in bytes """
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peakRss if sys.platform == "darwin" else peakRss * 1024
+
+
+def write_file(filePath, size, accessTime):
+    with open(filePath, "wb") as openFile:
+        openFile.write((FILE_CONTENTS * (size // len(FILE_CONTENTS) + 1))[:size])
+    os.utime(filePath, (accessTime, accessTime))
+
+
+def build_tier(tierPath, entryCount, options, now):
+    """Fills tierPath with entryCount files and returns the top level entries.
+    Every dir_every-th entry is a directory nesting its file depth levels
+    deep, and every stale_every-th entry is older than the stale cutoffs"""
+    os.makedirs(tierPath)
+    entries = []
+    for index in range(entryCount):
+        isStale = index % options.stale_every == 0
+        accessTime = now - (90 * DAY if isStale else 0)
+        entryPath = os.path.join(tierPath, "entry{:07d}".format(index))
+
+        if options.dir_every and index % options.dir_every == 0:
+            leafDirectory = os.path.join(
+                entryPath, *["level{}".format(level) for level in range(options.depth)]
+            )
+            os.makedirs(leafDirectory)
+            write_file(
+                os.path.join(leafDirectory, "leaf"), options.file_size, accessTime
+            )
+            os.utime(entryPath, (accessTime, accessTime))
+        else:
+            write_file(entryPath, options.file_size, accessTime)
+
+        entries.append((entryPath, accessTime))
+
+    return entries
+
+
+def build_environment(rootPath, entryCount, options):
+    """Builds the three tiers and their records in rootPath, splitting
+    entryCount between downloads, archives and purges by half, a quarter and
+    a quarter. Returns the configuration and the paths of the record stores"""
+    now = time.time()
+    downloadPath = os.path.join(rootPath, "downloads")
+    archivePath = os.path.join(rootPath, "archives")
+    purgePath = os.path.join(rootPath, "purges")
+
+    build_tier(downloadPath, entryCount // 2, options, now)
+    archiveEntries = build_tier(archivePath, entryCount // 4, options, now)
+    purgeEntries = build_tier(
+        purgePath, entryCount - entryCount // 2 - entryCount // 4, options, now
+    )
+
+    namespace = argparse.Namespace(
+        download_directories=[downloadPath],
+        archive_directories=[archivePath],
+        purge_directories=[purgePath],
+        blacklisted_paths=[],
+        record_backend=options.backend,
+        compression_codec=options.codec,
+        compression_workers=options.compression_workers,
+        metadata_workers=options.metadata_workers,
+        metadata_workers_per_mount=options.metadata_workers_per_mount,
+        compress_archives=not options.skip_compression,
+        evict_on_disk_pressure=False,
+        records=os.path.join(rootPath, "records.yaml"),
+        records_db=os.path.join(rootPath, "records.db"),
+    )
+    configMgr = download_sweeper.ConfigurationManager(
+        os.path.join(rootPath, "config.yaml"), namespace, loadFile=False
+    )
+
+    records = download_sweeper.create_record_keeper(configMgr, namespace)
+    records.load_existing_records()
+    for configType, entries in (
+        (ConfigKeyTranslator.ARCHIVES, archiveEntries),
+        (ConfigKeyTranslator.PURGES, purgeEntries),
+    ):
+        for entryPath, accessTime in entries:
+            records.add_record(entryPath, configType, int(accessTime))
+    records.write_records()
+
+    return configMgr, namespace
+
+
+class PhaseTimer(object):
+    """ Times the phases of one benchmark run """
+
+    def __init__(self):
+        self.phases = []
+
+    def run(self, name, function, itemCount=None):
+        """Runs function, records its duration and the peak RSS after it and
+        returns its result. itemCount is the number of entries the phase
+        handles, or a function of the result that returns it"""
+        startTime = time.perf_counter()
+        result = function()
+        duration = time.perf_counter() - startTime
+
+        if callable(itemCount):
+            itemCount = itemCount(result)
+        self.phases.append(
+            {
+                "phase": name,
+                "seconds": duration,
+                "items": itemCount,
+                "items_per_second": itemCount / duration
+                if itemCount is not None and duration > 0
+                else None,
+                "peak_rss_bytes": peak_rss_bytes(),
+            }
+        )
+        return result
+
+
+def benchmark_size(entryCount, options):
+    """Builds an environment of entryCount entries and times a sweep over it.
+    The moves run delete, purge, archive and then compress so that no phase
+    touches the entries of an earlier one, and the stale entries of every
+    tier are found up front the same way a sweep plan finds them"""
+    rootPath = tempfile.mkdtemp(prefix="download-sweeper-bench-", dir=options.tmpdir)
+    try:
+        buildStart = time.perf_counter()
+        configMgr, namespace = build_environment(rootPath, entryCount, options)
+        buildSeconds = time.perf_counter() - buildStart
+        buildRss = peak_rss_bytes()
+
+        sweeper = download_sweeper.Sweeper(configMgr)
+        records = download_sweeper.create_record_keeper(configMgr, namespace)
+        timer = PhaseTimer()
+
+        timer.run(
+            "load_existing_records", records.load_existing_records, entryCount // 2
+        )
+        timer.run(
+            "reconcile_records",
+            lambda: download_sweeper.reconcile_records(sweeper, records),
+            entryCount // 2,
+        )
+
+        staleFiles = {}
+        for configType in (
+            ConfigKeyTranslator.DOWNLOADS,
+            ConfigKeyTranslator.ARCHIVES,
+            ConfigKeyTranslator.PURGES,
+        ):
+            configTranslator = ConfigKeyTranslator(configType)
+            staleFiles[configType] = timer.run(
+                "get_stale_file_paths[{}]".format(configType),
+                lambda: list(sweeper.get_stale_file_paths(configTranslator, records)),
+                lambda stale: len(
+                    os.listdir(configMgr.get_option_value(configTranslator.path_key)[0])
+                ),
+            )
+
+        timer.run(
+            "delete_files",
+            lambda: download_sweeper.delete_files(
+                staleFiles[ConfigKeyTranslator.PURGES], configMgr, records
+            ),
+            len(staleFiles[ConfigKeyTranslator.PURGES]),
+        )
+        timer.run(
+            "purge_files",
+            lambda: download_sweeper.purge_files(
+                staleFiles[ConfigKeyTranslator.ARCHIVES], configMgr, records
+            ),
+            len(staleFiles[ConfigKeyTranslator.ARCHIVES]),
+        )
+        timer.run(
+            "archive_files",
+            lambda: download_sweeper.archive_files(
+                staleFiles[ConfigKeyTranslator.DOWNLOADS], configMgr, records
+            ),
+            len(staleFiles[ConfigKeyTranslator.DOWNLOADS]),
+        )
+        if not options.skip_compression:
+            timer.run(
+                "compress_archive_files",
+                lambda: download_sweeper.compress_archive_files(configMgr, records),
+                len(records.get_filepaths_in_type(ConfigKeyTranslator.ARCHIVES)),
+            )
+        timer.run(
+            "write_records",
+            records.write_records,
+            sum(
+                len(records.get_filepaths_in_type(configType))
+                for configType in (
+                    ConfigKeyTranslator.ARCHIVES,
+                    ConfigKeyTranslator.PURGES,
+                )
+            ),
+        )
+
+        return {
+            "entries": entryCount,
+            "build_seconds": buildSeconds,
+            "build_peak_rss_bytes": buildRss,
+            "total_seconds": sum(phase["seconds"] for phase in timer.phases),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "phases": timer.phases,
+        }
+    finally:
+        shutil.rmtree(rootPath, ignore_errors=True)
+
+
+def run_isolated(entryCount, options):
+    """Benchmarks one size in a fresh process, so that the peak RSS of a run
+    is not carried over from a larger one"""
+    with ProcessPoolExecutor(1, multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(benchmark_size, entryCount, options).result()
+
+
+argParser = argparse.ArgumentParser(
+    description="Benchmark every sweep phase over synthetic trees"
+)
+argParser.add_argument(
+    "--sizes",
+    type=int,
+    nargs="+",
+    default=[1000, 10000, 100000, 1000000],
+    help="Total numbers of entries over all three tiers to benchmark",
+)
+argParser.add_argument(
+    "--depth",
+    type=int,
+    default=3,
+    help="How many directories deep the file of a directory entry is",
+)
+argParser.add_argument(
+    "--dir-every",
+    type=int,
+    default=10,
+    help="Make every Nth entry a directory instead of a file (0 for none)",
+    dest="dir_every",
+)
+argParser.add_argument(
+    "--stale-every",
+    type=int,
+    default=2,
+    help="Make every Nth entry stale",
+    dest="stale_every",
+)
+argParser.add_argument(
+    "--file-size",
+    type=int,
+    default=4096,
+    help="Size of every file in bytes",
+    dest="file_size",
+)
+argParser.add_argument(
+    "--backend", choices=["yaml", "sqlite"], default="sqlite", help="Record backend"
+)
+argParser.add_argument("--codec", default="zip", help="Compression codec")
+argParser.add_argument(
+    "--compression-workers",
+    type=int,
+    default=0,
+    help="Compression processes, 0 for one per CPU",
+    dest="compression_workers",
+)
+argParser.add_argument(
+    "--metadata-workers",
+    type=int,
+    default=1,
+    help="Threads for stat and exists calls, 1 to make them in turn",
+    dest="metadata_workers",
+)
+argParser.add_argument(
+    "--metadata-workers-per-mount",
+    type=int,
+    default=4,
+    help="Most metadata calls in flight on one filesystem",
+    dest="metadata_workers_per_mount",
+)
+argParser.add_argument(
+    "--skip-compression",
+    action="store_true",
+    help="Do not benchmark compress_archive_files",
+    dest="skip_compression",
+)
+argParser.add_argument(
+    "--tmpdir", default=None, help="Directory to build the trees in"
+)
+argParser.add_argument(
+    "--output", default="-", help="File to write the JSON report to (default: stdout)"
+)
+
+
+def main():
+    parsed_args = argParser.parse_args()
+    report = {
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": vars(parsed_args),
+        "runs": [
+            run_isolated(entryCount, parsed_args) for entryCount in parsed_args.sizes
+        ],
+    }
+
+    reportJson = json.dumps(report, indent=2, sort_keys=True)
+    if parsed_args.output == "-":
+        print(reportJson)
+    else:
+        with open(parsed_args.output, "w+") as reportFile:
+            reportFile.write(reportJson + "\n")
+
+
+if __name__ == "__main__":
+    main()
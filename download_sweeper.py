@@ -11,14 +11,47 @@
 import argparse
 import errno
 import fnmatch
+import heapq
+import json
 import os
 import re
-import shutil
+import signal
+import stat
+import struct
+import sys
+import threading
 import time
-from datetime import datetime, timedelta
-from zipfile import ZipFile
+import zlib
+from contextlib import contextmanager
+from datetime import timedelta
+from types import MappingProxyType
 
-import yaml  # PyYAML
+# Modules that only some phases need (yaml, sqlite3, shutil, tempfile, the
+# compression modules, ctypes, concurrent.futures, ...) are imported inside
+# the functions that use them, so that runs with nothing to do start quickly
+
+
+def import_zstandard():
+    """ Returns the optional zstandard module, or None if it is not installed """
+    try:
+        import zstandard  # Optional, enables the zstd compression codec
+    except ImportError:
+        return None
+    return zstandard
+
+
+def yaml_load(stream):
+    """ Parses YAML with the libyaml based loader if PyYAML was built with it """
+    import yaml  # PyYAML
+
+    return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def yaml_dump(data):
+    """ Serializes YAML with the libyaml based dumper if PyYAML was built with it """
+    import yaml  # PyYAML
+
+    return yaml.dump(data, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
 
 
 def get_config_path(filename):
@@ -40,6 +73,16 @@ def assert_dir_exists(path):
             raise
 
 
+def fsync_directory(path):
+    """Flushes the entries of a directory, so that a file renamed into it
+    survives a crash"""
+    directoryFd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(directoryFd)
+    finally:
+        os.close(directoryFd)
+
+
 # Setup the commandline arguments
 argParser = argparse.ArgumentParser(description="Manage old downloaded files")
 argParser.add_argument(
@@ -58,6 +101,55 @@ argParser.add_argument(
     ),
 )
 
+argParser.add_argument(
+    "--records-db",
+    default=get_config_path("records.db"),
+    help="The location of the SQLite records database, default: {0}".format(
+        get_config_path("records.db")
+    ),
+    dest="records_db",
+)
+
+argParser.add_argument(
+    "--archive-index",
+    default=get_config_path("archive-index.db"),
+    help="""The location of the database indexing what every archive holds,
+    default: {0}""".format(
+        get_config_path("archive-index.db")
+    ),
+    dest="archive_index",
+)
+
+argParser.add_argument(
+    "--state",
+    default=get_config_path("state.json"),
+    help="""The location of the state file that lets runs with nothing to do
+    exit early, default: {0}""".format(
+        get_config_path("state.json")
+    ),
+    dest="state",
+)
+
+argParser.add_argument(
+    "--journal",
+    default=get_config_path("journal.jsonl"),
+    help="""The location of the journal of operations and record changes not
+    yet written to the records, which a run replays after an interrupted one,
+    default: {0}""".format(
+        get_config_path("journal.jsonl")
+    ),
+    dest="journal",
+)
+
+argParser.add_argument(
+    "--record-backend",
+    default=argparse.SUPPRESS,
+    choices=["yaml", "sqlite"],
+    help="""The backend used to store records. The YAML records file is
+    migrated into the database the first time the sqlite backend is used""",
+    dest="record_backend",
+)
+
 # Functionality enable settings
 archiveDownloadsGrp = argParser.add_mutually_exclusive_group()
 archiveDownloadsGrp.add_argument(
@@ -112,6 +204,266 @@ compressArchivesGrp.add_argument(
     dest="compress_archives",
 )
 
+fastExitGrp = argParser.add_mutually_exclusive_group()
+fastExitGrp.add_argument(
+    "--fast-exit",
+    default=argparse.SUPPRESS,
+    help="""Exit right away when no tier directory changed and nothing is due
+    since the last sweep""",
+    action="store_true",
+    dest="fast_exit",
+)
+fastExitGrp.add_argument(
+    "--no-fast-exit",
+    default=argparse.SUPPRESS,
+    help="""Always sweep every tier directory""",
+    action="store_false",
+    dest="fast_exit",
+)
+
+indexArchivesGrp = argParser.add_mutually_exclusive_group()
+indexArchivesGrp.add_argument(
+    "--index-archives",
+    default=argparse.SUPPRESS,
+    help="""Keep the archive index of what every archive holds up to date""",
+    action="store_true",
+    dest="index_archives",
+)
+indexArchivesGrp.add_argument(
+    "--no-index-archives",
+    default=argparse.SUPPRESS,
+    help="""Do not update the archive index""",
+    action="store_false",
+    dest="index_archives",
+)
+deduplicateArchivesGrp = argParser.add_mutually_exclusive_group()
+deduplicateArchivesGrp.add_argument(
+    "--deduplicate-archives",
+    default=argparse.SUPPRESS,
+    help="""Archived files with identical contents should be hardlinked to
+    one stored copy""",
+    action="store_true",
+    dest="deduplicate_archives",
+)
+deduplicateArchivesGrp.add_argument(
+    "--no-deduplicate-archives",
+    default=argparse.SUPPRESS,
+    help="""Archived files should not be deduplicated""",
+    action="store_false",
+    dest="deduplicate_archives",
+)
+
+argParser.add_argument(
+    "--metadata-workers",
+    default=argparse.SUPPRESS,
+    type=int,
+    help="""Number of threads that stat tier entries and check records
+    concurrently, 1 to make every call in turn""",
+    dest="metadata_workers",
+)
+argParser.add_argument(
+    "--metadata-workers-per-mount",
+    default=argparse.SUPPRESS,
+    type=int,
+    help="""Most metadata calls in flight at once on any one filesystem""",
+    dest="metadata_workers_per_mount",
+)
+
+argParser.add_argument(
+    "--deletion-workers",
+    default=argparse.SUPPRESS,
+    type=int,
+    help="""Threads that delete the directories of a purged tree concurrently""",
+    dest="deletion_workers",
+)
+argParser.add_argument(
+    "--io-bytes-per-second",
+    default=argparse.SUPPRESS,
+    help="""Most bytes per second read and written while moving, compressing
+    and hashing, such as 50M. 0 for no limit""",
+    dest="io_bytes_per_second",
+)
+argParser.add_argument(
+    "--io-ops-per-second",
+    default=argparse.SUPPRESS,
+    type=int,
+    help="""Most renames and deletions per second, 0 for no limit""",
+    dest="io_ops_per_second",
+)
+ioIdlePriorityGrp = argParser.add_mutually_exclusive_group()
+ioIdlePriorityGrp.add_argument(
+    "--io-idle-priority",
+    default=argparse.SUPPRESS,
+    help="""Only use the disks when nothing else does (idle I/O class)""",
+    action="store_true",
+    dest="io_idle_priority",
+)
+ioIdlePriorityGrp.add_argument(
+    "--no-io-idle-priority",
+    default=argparse.SUPPRESS,
+    help="""Use the default I/O priority""",
+    action="store_false",
+    dest="io_idle_priority",
+)
+argParser.add_argument(
+    "--max-load-average",
+    default=argparse.SUPPRESS,
+    type=float,
+    help="""Pause I/O while the 1 minute load average is above this, 0 to
+    never pause""",
+    dest="max_load_average",
+)
+argParser.add_argument(
+    "--max-disk-queue-depth",
+    default=argparse.SUPPRESS,
+    type=int,
+    help="""Pause I/O while more requests than this are in flight on a tier
+    disk, 0 to never pause""",
+    dest="max_disk_queue_depth",
+)
+
+argParser.add_argument(
+    "--compression-codec",
+    default=argparse.SUPPRESS,
+    choices=["zip", "gzip", "bz2", "lzma", "zstd"],
+    help="""The codec archived files are compressed with (zstd requires the
+    zstandard package)""",
+    dest="compression_codec",
+)
+argParser.add_argument(
+    "--compression-level",
+    default=argparse.SUPPRESS,
+    type=int,
+    help="""The compression level passed to the codec""",
+    dest="compression_level",
+)
+argParser.add_argument(
+    "--compression-workers",
+    default=argparse.SUPPRESS,
+    type=int,
+    help="""The number of processes used to compress archives, 0 for one per
+    CPU""",
+    dest="compression_workers",
+)
+
+evictGrp = argParser.add_mutually_exclusive_group()
+evictGrp.add_argument(
+    "--evict-on-disk-pressure",
+    default=argparse.SUPPRESS,
+    help="""Move entries on to their next tier early when a filesystem's free
+    space drops below free_space_low_watermark""",
+    action="store_true",
+    dest="evict_on_disk_pressure",
+)
+evictGrp.add_argument(
+    "--no-evict-on-disk-pressure",
+    default=argparse.SUPPRESS,
+    help="""Only move entries once they become stale""",
+    action="store_false",
+    dest="evict_on_disk_pressure",
+)
+
+planGrp = argParser.add_mutually_exclusive_group()
+planGrp.add_argument(
+    "--dry-run",
+    default=None,
+    nargs="?",
+    const="-",
+    metavar="PLAN",
+    help="""Only plan the sweep and write the plan, with the bytes and I/O of
+    every operation, as JSON to PLAN (default: stdout)""",
+    dest="dry_run",
+)
+planGrp.add_argument(
+    "--apply-plan",
+    default=None,
+    metavar="PLAN",
+    help="""Run the operations of a plan written by --dry-run, skipping those
+    whose source changed since""",
+    dest="apply_plan",
+)
+
+archiveSearchGrp = argParser.add_mutually_exclusive_group()
+archiveSearchGrp.add_argument(
+    "--find",
+    default=None,
+    metavar="QUERY",
+    help="""List the archived files whose name matches QUERY (a glob pattern),
+    whose original path is or is inside QUERY if it is absolute, or whose
+    BLAKE2b hash is QUERY, with the archive and member holding each""",
+    dest="find",
+)
+archiveSearchGrp.add_argument(
+    "--restore",
+    default=None,
+    metavar="PATH",
+    help="""Restore the archived file or directory that was at PATH, reading
+    only what it needs out of the archives holding it""",
+    dest="restore",
+)
+argParser.add_argument(
+    "--restore-to",
+    default=None,
+    metavar="DIRECTORY",
+    help="""Restore into DIRECTORY instead of the original location""",
+    dest="restore_to",
+)
+
+argParser.add_argument(
+    "--daemon",
+    default=False,
+    action="store_true",
+    help="""Keep running, watching the download, archive and purge directories
+    and acting on each entry as soon as it becomes stale""",
+    dest="daemon",
+)
+
+argParser.add_argument(
+    "--metrics-textfile",
+    default=argparse.SUPPRESS,
+    metavar="PATH",
+    help="""Write the phase timings and counts of the run in the node_exporter
+    textfile format to PATH""",
+    dest="metrics_textfile",
+)
+argParser.add_argument(
+    "--metrics-json",
+    default=argparse.SUPPRESS,
+    metavar="PATH",
+    help="""Write the phase timings and counts of the run as JSON to PATH""",
+    dest="metrics_json",
+)
+argParser.add_argument(
+    "--profile",
+    default=None,
+    metavar="PATH",
+    help="""Profile the run with cProfile and dump the stats to PATH""",
+    dest="profile",
+)
+
+argParser.add_argument(
+    "--system",
+    default=False,
+    action="store_true",
+    help="""Sweep every user that has a ~/.config/download-sweeper/config.yaml,
+    each with their own configuration and records and as that user""",
+    dest="system",
+)
+argParser.add_argument(
+    "--system-workers",
+    default=4,
+    type=int,
+    help="""Most users swept at once by --system, default: 4""",
+    dest="system_workers",
+)
+argParser.add_argument(
+    "--system-min-uid",
+    default=1000,
+    type=int,
+    help="""Lowest uid of the users swept by --system, default: 1000""",
+    dest="system_min_uid",
+)
+
 deleteFromPurgeGrp = argParser.add_mutually_exclusive_group()
 deleteFromPurgeGrp.add_argument(
     "--delete-from-purge",
@@ -130,6 +482,362 @@ deleteFromPurgeGrp.add_argument(
 )
 
 
+class SweepMetrics(object):
+    """Counts and times the work of a run, so that it can be exported in the
+    node_exporter textfile format and as JSON. Counters keep growing over the
+    lifetime of a daemon, the way Prometheus counters are expected to"""
+
+    PREFIX = "download_sweeper"
+    COUNTERS = {
+        "files_scanned": "Entries found while scanning tier directories",
+        "stat_calls": "stat calls made while scanning and planning",
+        "bytes_moved": "Bytes moved into archive and purge directories",
+        "bytes_compressed": "Bytes of archives that were compressed",
+        "bytes_saved": "Bytes saved by compressing archives",
+        "bytes_deduplicated": "Bytes of archives replaced by hardlinks",
+        "bytes_deleted": "Bytes deleted from purge directories",
+        "bytes_reclaimed": "Bytes of disk space freed by deleting",
+        "deletions": "Entries deleted from purge directories",
+        "operations_replayed": "Interrupted operations finished from the journal",
+        "errors": "Operations that failed",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.phaseSeconds = {}
+        self.phaseRuns = {}
+        self.startTime = time.time()
+        self.succeeded = None
+
+    def count(self, name, amount=1):
+        with self.lock:  # Metadata calls are counted from several threads
+            self.counters[name] += amount
+
+    @contextmanager
+    def phase(self, name):
+        """ Adds the wall time of the enclosed block to a phase """
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phaseSeconds[name] = (
+                self.phaseSeconds.get(name, 0) + time.perf_counter() - startTime
+            )
+            self.phaseRuns[name] = self.phaseRuns.get(name, 0) + 1
+
+    def finish(self, succeeded):
+        self.succeeded = succeeded
+
+    def merge(self, metricsDict):
+        """ Adds the counters and phase timings of another run's to_dict """
+        for name, amount in metricsDict["counters"].items():
+            self.count(name, amount)
+        for name, phase in metricsDict["phases"].items():
+            self.phaseSeconds[name] = self.phaseSeconds.get(name, 0) + phase["seconds"]
+            self.phaseRuns[name] = self.phaseRuns.get(name, 0) + phase["runs"]
+
+    def to_dict(self):
+        return {
+            "start_time": self.startTime,
+            "run_seconds": time.time() - self.startTime,
+            "succeeded": self.succeeded,
+            "counters": dict(self.counters),
+            "phases": {
+                name: {"seconds": seconds, "runs": self.phaseRuns[name]}
+                for name, seconds in self.phaseSeconds.items()
+            },
+        }
+
+    def to_textfile(self):
+        """ Returns the metrics in the Prometheus text exposition format """
+        metricsDict = self.to_dict()
+        lines = []
+
+        def add_metric(name, metricType, helpText, samples):
+            lines.append("# HELP {}_{} {}".format(self.PREFIX, name, helpText))
+            lines.append("# TYPE {}_{} {}".format(self.PREFIX, name, metricType))
+            for labels, value in samples:
+                lines.append("{}_{}{} {}".format(self.PREFIX, name, labels, value))
+
+        for name, helpText in sorted(self.COUNTERS.items()):
+            add_metric(
+                name + "_total", "counter", helpText, [("", self.counters[name])]
+            )
+        add_metric(
+            "phase_seconds",
+            "gauge",
+            "Wall time spent in each phase",
+            [
+                ('{{phase="{}"}}'.format(name), "{:.6f}".format(seconds))
+                for name, seconds in sorted(self.phaseSeconds.items())
+            ],
+        )
+        add_metric(
+            "run_start_time_seconds",
+            "gauge",
+            "When the run started",
+            [("", "{:.3f}".format(metricsDict["start_time"]))],
+        )
+        add_metric(
+            "run_seconds",
+            "gauge",
+            "Wall time of the run so far",
+            [("", "{:.6f}".format(metricsDict["run_seconds"]))],
+        )
+        if self.succeeded is not None:
+            add_metric(
+                "run_success",
+                "gauge",
+                "Whether the run finished without an exception",
+                [("", int(self.succeeded))],
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, contents):
+        """Writes to a temporary file that is renamed over path, so that
+        node_exporter never reads a half-written file"""
+        directoryPath = os.path.dirname(os.path.abspath(path))
+        import tempfile
+
+        fd, temporaryPath = tempfile.mkstemp(
+            prefix=".{}.".format(os.path.basename(path)), dir=directoryPath
+        )
+        try:
+            with os.fdopen(fd, "w") as temporaryFile:
+                temporaryFile.write(contents)
+            os.chmod(temporaryPath, 0o644)
+            os.replace(temporaryPath, path)
+        except BaseException:
+            os.unlink(temporaryPath)
+            raise
+
+    def export(self, configurationManager):
+        """ Writes the configured textfile and JSON exports, if any """
+        self.export_to(
+            configurationManager.get_option_value("metrics_textfile"),
+            configurationManager.get_option_value("metrics_json"),
+        )
+
+    def export_to(self, textfilePath, jsonPath):
+        if textfilePath:
+            self.write(textfilePath, self.to_textfile())
+        if jsonPath:
+            self.write(jsonPath, json.dumps(self.to_dict(), indent=2, sort_keys=True))
+
+
+METRICS = SweepMetrics()
+
+
+class TokenBucket(object):
+    """Lets rate units through per second on average, in bursts of up to one
+    second's worth. A request larger than what is left is let through and
+    pays back its debt by sleeping, so large chunks cannot stall forever"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.updatedTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updatedTime) * self.rate
+            )
+            self.updatedTime = now
+            self.tokens -= amount
+            debt = -self.tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30}
+
+
+def set_idle_io_priority():
+    """Puts this process in the idle I/O scheduling class, so that its disk
+    requests are only served when no one else wants the disk. Returns whether
+    that worked"""
+    import ctypes
+    import ctypes.util
+    import platform
+
+    syscallNumber = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if syscallNumber is None:
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return (
+        libc.syscall(
+            syscallNumber,
+            IOPRIO_WHO_PROCESS,
+            0,
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT,
+        )
+        == 0
+    )
+
+
+class IOThrottle(object):
+    """The I/O budget of a sweep. Transfers, compression, hashing and
+    deletions report the bytes and operations they are about to do, and are
+    held back by token buckets and while the system is busy: while the load
+    average or the number of requests in flight on a tier disk is above its
+    threshold, for at most max_pause seconds at a time"""
+
+    BUSY_CHECK_INTERVAL = 0.5
+
+    def __init__(self):
+        self.apply_settings({})
+
+    def apply_settings(self, settings):
+        self.settings = dict(settings)
+        bytesPerSecond = settings.get("bytes_per_second")
+        opsPerSecond = settings.get("ops_per_second")
+        self.byteBucket = TokenBucket(bytesPerSecond) if bytesPerSecond else None
+        self.opBucket = TokenBucket(opsPerSecond) if opsPerSecond else None
+        self.maxLoadAverage = settings.get("max_load_average")
+        self.maxQueueDepth = settings.get("max_queue_depth")
+        self.inflightPaths = settings.get("inflight_paths", [])
+        self.maxPause = settings.get("max_pause", 0)
+        self.lastBusyCheck = 0
+        if settings.get("idle_priority") and not set_idle_io_priority():
+            print("Could not set the idle I/O priority class")
+
+    def configure(self, configurationManager):
+        """ Applies the I/O options of a configuration """
+        bytesPerSecond = configurationManager.get_option_value("io_bytes_per_second")
+        self.apply_settings(
+            {
+                "bytes_per_second": ConfigFileSizeParser.bytes_from_config_str(
+                    bytesPerSecond, 0
+                )
+                if bytesPerSecond
+                else 0,
+                "ops_per_second": configurationManager.get_option_value(
+                    "io_ops_per_second"
+                ),
+                "idle_priority": configurationManager.get_option_value(
+                    "io_idle_priority"
+                ),
+                "max_load_average": configurationManager.get_option_value(
+                    "max_load_average"
+                ),
+                "max_queue_depth": configurationManager.get_option_value(
+                    "max_disk_queue_depth"
+                ),
+                "inflight_paths": self.inflight_paths(configurationManager),
+                "max_pause": configurationManager.get_option_value("io_max_pause"),
+            }
+        )
+
+    @staticmethod
+    def inflight_paths(configurationManager):
+        """Returns the sysfs inflight counters of the block devices holding
+        the tier directories. Filesystems without one, like NFS, have none"""
+        inflightPaths = set()
+        for configType in (
+            ConfigKeyTranslator.DOWNLOADS,
+            ConfigKeyTranslator.ARCHIVES,
+            ConfigKeyTranslator.PURGES,
+        ):
+            for directoryPath in configurationManager.get_option_value(
+                ConfigKeyTranslator(configType).path_key
+            ):
+                device = device_of(directoryPath)
+                if device is None:
+                    continue
+                inflightPath = "/sys/dev/block/{}:{}/inflight".format(
+                    os.major(device), os.minor(device)
+                )
+                if os.path.exists(inflightPath):
+                    inflightPaths.add(inflightPath)
+        return sorted(inflightPaths)
+
+    def shared_settings(self, shares):
+        """ Returns settings that split the budget between shares processes """
+        settings = dict(self.settings)
+        for key in ("bytes_per_second", "ops_per_second"):
+            if settings.get(key):
+                settings[key] = max(1, settings[key] / shares)
+        return settings
+
+    def queue_depth(self):
+        queueDepth = 0
+        for inflightPath in self.inflightPaths:
+            try:
+                with open(inflightPath, "r") as inflightFile:
+                    queueDepth += sum(
+                        int(count) for count in inflightFile.read().split()
+                    )
+            except (OSError, ValueError):
+                continue
+        return queueDepth
+
+    def is_busy(self):
+        if self.maxLoadAverage and os.getloadavg()[0] > self.maxLoadAverage:
+            return True
+        return bool(self.maxQueueDepth) and self.queue_depth() > self.maxQueueDepth
+
+    def wait_while_busy(self):
+        if not (self.maxLoadAverage or self.maxQueueDepth):
+            return
+        now = time.monotonic()
+        if now - self.lastBusyCheck < self.BUSY_CHECK_INTERVAL:
+            return
+
+        pauseEnd = now + self.maxPause
+        while self.is_busy() and time.monotonic() < pauseEnd:
+            time.sleep(self.BUSY_CHECK_INTERVAL)
+        self.lastBusyCheck = time.monotonic()
+
+    def use_bytes(self, byteCount):
+        """ Waits until byteCount bytes of I/O fit in the budget """
+        self.wait_while_busy()
+        if self.byteBucket is not None:
+            self.byteBucket.consume(byteCount)
+
+    def use_operation(self):
+        """ Waits until one metadata operation fits in the budget """
+        self.wait_while_busy()
+        if self.opBucket is not None:
+            self.opBucket.consume(1)
+
+    def limits_operations(self):
+        return self.opBucket is not None
+
+
+THROTTLE = IOThrottle()
+
+
+def configure_worker_throttle(settings):
+    """ Applies the share of the I/O budget of a compression process """
+    THROTTLE.apply_settings(settings)
+
+
+class ThrottledReader(object):
+    """Wraps a binary file object so that reading it uses the I/O budget.
+    What is read is also fed to digest, if one is given"""
+
+    def __init__(self, rawFile, digest=None):
+        self.rawFile = rawFile
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.rawFile.read(size)
+        THROTTLE.use_bytes(len(data))
+        if self.digest is not None:
+            self.digest.update(data)
+        return data
+
+
 class ConfigKeyTranslator(object):
     DOWNLOADS = "downloads"
     ARCHIVES = "archive"
@@ -147,9 +855,214 @@ class ConfigKeyTranslator(object):
 
 
 class File(object):
+    __slots__ = ("path",)
+
     def __init__(self, path):
         self.path = path
-        self.filename = os.path.basename(path)
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+
+class ScannedFile(File):
+    """A file or directory found at the top level of a tier directory, with
+    __slots__ since a scan makes one per entry. configType is the tier it was
+    found in, lastAccessTime the newest access time found in it (None if it
+    was not collected or the directory holds no files), size the apparent
+    size of everything in it and device, inode and mtimeNs its identity from
+    its lstat result, when collected"""
+
+    __slots__ = (
+        "configType",
+        "isDir",
+        "lastAccessTime",
+        "size",
+        "device",
+        "inode",
+        "mtimeNs",
+    )
+
+    def __init__(
+        self,
+        path,
+        isDir,
+        lastAccessTime=None,
+        size=None,
+        fileDetails=None,
+        configType=None,
+    ):
+        super(ScannedFile, self).__init__(path)
+        self.configType = configType
+        self.isDir = isDir
+        self.lastAccessTime = lastAccessTime
+        self.size = size
+        self.device = self.inode = self.mtimeNs = None
+        if fileDetails is not None:
+            self.device = fileDetails.st_dev
+            self.inode = fileDetails.st_ino
+            self.mtimeNs = fileDetails.st_mtime_ns
+
+
+class BlacklistMatcher(object):
+    """Matches paths against the blacklisted_paths patterns. Literal patterns
+    are looked up in a set and all glob patterns are merged into one regex,
+    so a path is checked once no matter how many patterns there are"""
+
+    glob_pattern = re.compile(r"[*?[]")
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        self.literalPaths = set()
+        globRegexes = []
+        for pattern in self.patterns:
+            pattern = os.path.normcase(pattern)
+            if self.glob_pattern.search(pattern):
+                globRegexes.append("(?:{})".format(fnmatch.translate(pattern)))
+            else:
+                self.literalPaths.add(pattern)
+                self.literalPaths.add(pattern.rstrip(os.sep) or os.sep)
+
+        self.globRegex = re.compile("|".join(globRegexes)) if globRegexes else None
+
+    def matches(self, path):
+        path = os.path.normcase(path)
+        if path in self.literalPaths:
+            return True
+        return self.globRegex is not None and self.globRegex.match(path) is not None
+
+
+class MetadataPool(object):
+    """Runs metadata calls such as stat and exists on a thread pool, with at
+    most workersPerMount of them in flight on any one filesystem. On network
+    filesystems every call is a round trip, so overlapping them hides the
+    latency. Calls are submitted round robin over filesystems so that a slow
+    one does not hold up the others, and results come back in input order"""
+
+    WINDOW = 1024
+
+    def __init__(self, workers=1, workersPerMount=1):
+        self.workers = max(1, workers)
+        self.workersPerMount = max(1, workersPerMount)
+        self.devices = {}  # parentPath: st_dev
+
+    @classmethod
+    def from_config(cls, configurationManager):
+        return cls(
+            configurationManager.get_option_value("metadata_workers"),
+            configurationManager.get_option_value("metadata_workers_per_mount"),
+        )
+
+    def device_of_parent(self, path):
+        parentPath = os.path.dirname(path.rstrip(os.sep)) or os.sep
+        if parentPath not in self.devices:
+            self.devices[parentPath] = device_of(parentPath)
+        return self.devices[parentPath]
+
+    def map(self, function, items, pathOf=None):
+        """Returns [function(item)] for every item, whose path is pathOf(item)
+        or the item itself"""
+        items = list(items)
+        if self.workers == 1 or len(items) < 2:
+            return [function(item) for item in items]
+
+        from concurrent.futures import ThreadPoolExecutor
+        from itertools import zip_longest
+
+        indexesByDevice = {}
+        for index, item in enumerate(items):
+            path = item if pathOf is None else pathOf(item)
+            indexesByDevice.setdefault(self.device_of_parent(path), []).append(index)
+        semaphores = {
+            device: threading.BoundedSemaphore(self.workersPerMount)
+            for device in indexesByDevice
+        }
+
+        def call(item, semaphore):
+            with semaphore:
+                return function(item)
+
+        results = [None] * len(items)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {}
+            deviceIndexes = [
+                [(device, index) for index in indexes]
+                for device, indexes in indexesByDevice.items()
+            ]
+            for roundRobin in zip_longest(*deviceIndexes):
+                for device, index in filter(None, roundRobin):
+                    futures[index] = executor.submit(
+                        call, items[index], semaphores[device]
+                    )
+            for index, future in futures.items():
+                results[index] = future.result()
+
+        return results
+
+    def imap(self, function, items, pathOf=None):
+        """Yields (item, function(item)) for every item, in order, as items
+        come in. Items are taken WINDOW at a time and mapped with map, so
+        results come out before items runs out and only one window is ever
+        held in memory"""
+        if self.workers == 1:
+            for item in items:
+                yield item, function(item)
+            return
+
+        from itertools import islice
+
+        items = iter(items)
+        while True:
+            window = list(islice(items, self.WINDOW))
+            if not window:
+                return
+            for result in zip(window, self.map(function, window, pathOf)):
+                yield result
+
+
+def summarize_tree(directoryPath, blacklist=None):
+    """Returns (newestAccessTime, size) of the files beneath a directory, using
+    the stat result each DirEntry caches so every inode is stat'ed once.
+    Blacklisted paths are not stat'ed or descended into; a directory holding
+    one reports an infinite access time so it is never swept along with it"""
+    newestAccessTime, size = None, 0
+    pendingDirectories = [directoryPath]
+    while pendingDirectories:
+        try:
+            childEntries = os.scandir(pendingDirectories.pop())
+        except OSError:
+            continue
+
+        with childEntries:
+            for childEntry in childEntries:
+                if blacklist is not None and blacklist.matches(childEntry.path):
+                    return float("inf"), size
+
+                try:
+                    if childEntry.is_dir(follow_symlinks=False):
+                        pendingDirectories.append(childEntry.path)
+                        continue
+                    METRICS.count("stat_calls")
+                    childDetails = childEntry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                size += childDetails.st_size
+                if newestAccessTime is None or childDetails.st_atime > newestAccessTime:
+                    newestAccessTime = childDetails.st_atime
+
+    return newestAccessTime, size
+
+
+def scanned_file(path, fileDetails, blacklist=None, configType=None):
+    """ Creates the ScannedFile of an entry from its lstat result, walking it
+    once if it is a directory """
+    isDir = stat.S_ISDIR(fileDetails.st_mode)
+    if isDir:
+        lastAccessTime, size = summarize_tree(path, blacklist)
+    else:
+        lastAccessTime, size = fileDetails.st_atime, fileDetails.st_size
+    return ScannedFile(path, isDir, lastAccessTime, size, fileDetails, configType)
 
 
 class ConfigFileTimeDeltaParser(object):
@@ -187,109 +1100,236 @@ class ConfigFileTimeDeltaParser(object):
         )
 
 
-class Sweeper(object):
-    """An object used to sweep certain directories and move their stale
-    contents to the next directory"""
+class ConfigFileSizeParser(object):
+    """Parses sizes such as "10%" (of the filesystem), "512M" or "20G" from
+    the configuration file into bytes"""
 
-    def __init__(self, configManager):
-        """ Inititalizes the Sweeper with a certain set of configurations """
-        self.configManager = configManager
+    re_pattern = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmgtp%]?)b?$", re.IGNORECASE)
+    _multiplier_list = {
+        "": 1,
+        "k": 1024,
+        "m": 1024 ** 2,
+        "g": 1024 ** 3,
+        "t": 1024 ** 4,
+        "p": 1024 ** 5,
+    }
 
-    def file_is_stale(self, path, configTranslator, recordKeeper):
-        """
-        Determines if a path is stale by getting its last access time (or the time it was
-        added into archives/purge) and adding the configuration value to it.
-        """
-        if configTranslator.configType == ConfigKeyTranslator.DOWNLOADS:
-            lastAccessCDate = os.lstat(path).st_atime
-            lastAccessDatetime = datetime.strptime(
-                time.ctime(lastAccessCDate), "%a %b %d %H:%M:%S %Y"
-            )
-        else:
-            lastAccessDatetime = datetime.strptime(
-                recordKeeper.get_record(configTranslator.configType, path),
-                "%a %b %d %H:%M:%S %Y",
-            )
+    class InvalidConfigSizeStrException(Exception):
+        pass
 
-        adjLastAccessTime = (
-            lastAccessDatetime
-            + ConfigFileTimeDeltaParser.timedelta_from_config_str(
-                self.configManager.get_option_value(configTranslator.stale_limit_key)
+    @classmethod
+    def bytes_from_config_str(cls, configStr, totalBytes):
+        matchedPattern = cls.re_pattern.match(str(configStr).strip())
+        if matchedPattern is None:
+            raise cls.InvalidConfigSizeStrException(
+                "{} is an invalid size str".format(configStr)
             )
-        )
 
-        if adjLastAccessTime < datetime.today():
-            return True
-        else:
-            return False
+        value, unit = float(matchedPattern.group(1)), matchedPattern.group(2).lower()
+        if unit == "%":
+            return int(totalBytes * value / 100)
+        return int(value * cls._multiplier_list[unit])
 
-    def dir_is_stale(self, path, configTranslator, recordKeeper):
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if not self.file_is_stale(file, configTranslator, recordKeeper):
-                    return False
 
-        return True
+class Sweeper(object):
+    """An object used to sweep certain directories and move their stale
+    contents to the next directory"""
 
-    def path_should_be_skipped(self, path):
-        for blacklist_pattern in self.configManager.get_option_value(
-            "blacklisted_paths"
-        ):
-            if fnmatch.fnmatch(path, blacklist_pattern):
+    def __init__(self, configManager):
+        """ Inititalizes the Sweeper with a certain set of configurations """
+        self.configManager = configManager
+        self.nextDownloadDueTime = None  # When the first fresh download goes stale
+        self.freshDownloadDirectories = []
+
+    def get_stale_cutoff(self, configTranslator):
+        """Returns the epoch time before which files of the certain type of
+        directory are stale, parsing the configured limit only once"""
+        staleLimit = self.configManager.get_snapshot().staleLimits[
+            configTranslator.stale_limit_key
+        ]
+        return time.time() - staleLimit.total_seconds()
+
+    def file_is_stale(self, file, configTranslator, recordKeeper, staleCutoff):
+        """
+        Determines if a scanned file is stale by comparing its last access time (or
+        the time it was added into archives/purge) against the stale cutoff.
+        Directories use the newest access time of any file inside.
+        """
+        if configTranslator.configType == ConfigKeyTranslator.DOWNLOADS:
+            if file.lastAccessTime is None:
                 return True
+            lastAccessTime = file.lastAccessTime
+        else:
+            try:
+                lastAccessTime = recordKeeper.get_record(
+                    configTranslator.configType, file.path
+                )
+            except KeyError:
+                return False  # Untracked, it will be recorded as of now
 
-        return False
+        return lastAccessTime < staleCutoff
+
+    def get_blacklist(self):
+        """ Returns the blacklist compiled by the current config snapshot """
+        return self.configManager.get_snapshot().blacklist
+
+    def path_should_be_skipped(self, path):
+        return self.get_blacklist().matches(path)
 
     def get_stale_file_paths(self, configTranslator, recordKeeper):
         """
-        Gets the paths of all stale files in the certain type of directory.
+        Yields every stale file in the certain type of directory as the scan
+        finds it.
 
         Arguments:
         pathType: str - A member of ConfigKeyTranslator that determines which
                         directory we will be searching
         """
-        stalePaths = []
-        files, directories = self.get_all_file_paths(configTranslator)
+        withAccessTimes = configTranslator.configType == ConfigKeyTranslator.DOWNLOADS
+        if withAccessTimes:
+            # Only what this pass finds is still in the downloads
+            self.nextDownloadDueTime = None
+            self.freshDownloadDirectories = []
+        staleCutoff = self.get_stale_cutoff(configTranslator)
+        staleLimit = time.time() - staleCutoff
+        for file in self.iter_tier(configTranslator, withAccessTimes):
+            if self.file_is_stale(file, configTranslator, recordKeeper, staleCutoff):
+                yield file
+            elif withAccessTimes:
+                if file.isDir:
+                    self.freshDownloadDirectories.append(file.path)
+                dueTime = file.lastAccessTime + staleLimit
+                if self.nextDownloadDueTime is None:
+                    self.nextDownloadDueTime = dueTime
+                self.nextDownloadDueTime = min(self.nextDownloadDueTime, dueTime)
 
-        # First, let's check for stale files
-        for file in files:
-            if self.path_should_be_skipped(file):
-                continue
+    def scan_tier(self, configTranslator, withAccessTimes, unlistedDirectories=None):
+        """
+        Lists the top level of every directory in the certain type of directory
+        with a single os.scandir pass. Access times and sizes are only collected
+        (by walking each entry once) when withAccessTimes is set, with the stat
+        calls and walks spread over the metadata pool. Blacklisted paths are
+        pruned without being stat'ed or descended into. Directories that could
+        not be listed are added to unlistedDirectories, if it is given.
+
+        Return:
+        [ScannedFile] in directory order
+        """
+        return list(
+            self.iter_tier(configTranslator, withAccessTimes, unlistedDirectories)
+        )
 
-            if self.file_is_stale(file, configTranslator, recordKeeper):
-                stalePaths.append(File(file))
+    def iter_tier(self, configTranslator, withAccessTimes, unlistedDirectories=None):
+        """ Yields what scan_tier returns as it is found """
+        blacklist = self.get_blacklist()
+        configType = configTranslator.configType
+        dirEntries = self.iter_tier_entries(
+            configTranslator, blacklist, unlistedDirectories
+        )
+        if not withAccessTimes:
+            for dirEntry in dirEntries:
+                try:
+                    isDir = dirEntry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+                yield ScannedFile(dirEntry.path, isDir, configType=configType)
+            return
+
+        def scan_entry(dirEntry):
+            METRICS.count("stat_calls")
+            try:
+                fileDetails = dirEntry.stat(follow_symlinks=False)
+            except OSError:
+                return None
+            return scanned_file(dirEntry.path, fileDetails, blacklist, configType)
 
-        # Great, now let's check for stale directories (all files inside are stale)
-        for directory in directories:
-            if self.path_should_be_skipped(directory):
+        for dirEntry, file in MetadataPool.from_config(self.configManager).imap(
+            scan_entry, dirEntries, lambda dirEntry: dirEntry.path
+        ):
+            if file is not None:
+                yield file
+
+    def iter_tier_entries(self, configTranslator, blacklist, unlistedDirectories):
+        """ Yields the DirEntry of every entry of the tier that is not skipped """
+        for directoryPath in self.configManager.get_option_value(
+            configTranslator.path_key
+        ):
+            try:
+                directoryEntries = os.scandir(directoryPath)
+            except OSError:
+                if unlistedDirectories is not None:
+                    unlistedDirectories.add(directoryPath.rstrip(os.sep))
                 continue
 
-            if self.dir_is_stale(directory, configTranslator, recordKeeper):
-                stalePaths.append(File(directory))
+            with directoryEntries:
+                for dirEntry in directoryEntries:
+                    if is_transient_entry(dirEntry.name) or blacklist.matches(
+                        dirEntry.path
+                    ):
+                        continue
 
-        return stalePaths
+                    METRICS.count("files_scanned")
+                    yield dirEntry
 
-    def get_all_file_paths(self, configTranslator):
+    def scan_path(self, path, withAccessTimes):
         """
-        Gets the paths of all files and directories in the certain type of directory.
+        Scans a single top level entry of a tier directory the same way
+        scan_tier does.
 
         Return:
-        ([files], [directories])
+        ScannedFile, or None if it no longer exists or is blacklisted
         """
+        blacklist = self.get_blacklist()
+        if is_transient_entry(path) or blacklist.matches(path):
+            return None
 
-        files, directories = [], []
-        for directoryPath in self.configManager.get_option_value(
-            configTranslator.path_key
-        ):
+        METRICS.count("files_scanned")
+        METRICS.count("stat_calls")
+        try:
+            fileDetails = os.lstat(path)
+        except OSError:
+            return None
 
-            for root, dirs, filenames in os.walk(directoryPath):
-                files.extend([os.path.join(root, file) for file in filenames])
-                directories.extend(
-                    [os.path.join(root, directory) for directory in dirs]
-                )
-                break
+        if withAccessTimes:
+            return scanned_file(path, fileDetails, blacklist)
+        return ScannedFile(path, stat.S_ISDIR(fileDetails.st_mode))
+
+
+class ConfigSnapshot(object):
+    """An immutable view of every option, resolved once from the defaults, the
+    configuration file and the commandline arguments, in increasing order of
+    precedence. Lists are frozen into tuples, stale limits are parsed into
+    timedeltas and the blacklist is compiled, so per-file checks only do a
+    single lookup"""
+
+    __slots__ = ("options", "staleLimits", "blacklist", "configMtime")
+
+    STALE_LIMIT_KEYS = (
+        "download_stale_after",
+        "archive_stale_after",
+        "purge_stale_after",
+    )
+
+    def __init__(self, defaultConfig, configFileDict, argDictionary, configMtime=None):
+        options = dict(defaultConfig)
+        options.update(configFileDict or {})
+        options.update(argDictionary)
+        for key, value in options.items():
+            if isinstance(value, list):
+                options[key] = tuple(value)
+
+        self.options = MappingProxyType(options)
+        self.staleLimits = MappingProxyType(
+            {
+                key: ConfigFileTimeDeltaParser.timedelta_from_config_str(options[key])
+                for key in self.STALE_LIMIT_KEYS
+            }
+        )
+        self.blacklist = BlacklistMatcher(options["blacklisted_paths"])
+        self.configMtime = configMtime
 
-        return files, directories
+    def __getitem__(self, key):
+        return self.options[key]
 
 
 class ConfigurationManager(object):
@@ -310,6 +1350,8 @@ class ConfigurationManager(object):
             "archive_downloads": True,
             "purge_archives": True,
             "compress_archives": True,
+            "deduplicate_archives": False,
+            "index_archives": True,
             "delete_from_purge": True,
             "move_to_all_archive_dirs": True,
             "move_to_all_purge_dirs": True,
@@ -320,8 +1362,31 @@ class ConfigurationManager(object):
             "archive_directories": [],
             "purge_directories": [],
             "blacklisted_paths": [],
+            "record_backend": "sqlite",
+            "compression_codec": "zip",
+            "compression_level": None,
+            "compression_workers": 0,
+            "compression_min_ratio": 0.1,
+            "evict_on_disk_pressure": False,
+            "free_space_low_watermark": "10%",
+            "free_space_high_watermark": "20%",
+            "daemon_poll_interval": 60,
+            "daemon_rescan_interval": 86400,
+            "metrics_textfile": None,
+            "metrics_json": None,
+            "fast_exit": True,
+            "metadata_workers": 1,
+            "metadata_workers_per_mount": 4,
+            "deletion_workers": 4,
+            "io_bytes_per_second": 0,
+            "io_ops_per_second": 0,
+            "io_idle_priority": False,
+            "max_load_average": 0,
+            "max_disk_queue_depth": 0,
+            "io_max_pause": 300,
         }
 
+        self.snapshot = None
         if loadFile:
             self.load_config_file()
 
@@ -339,7 +1404,7 @@ class ConfigurationManager(object):
     def write_default_config_values(self):
         assert_dir_exists(os.path.dirname(self.config_file_path))
         with open(self.config_file_path, "w+") as config_file:
-            config_file.write(yaml.dump(self.default_config))
+            config_file.write(yaml_dump(self.default_config))
 
     def load_config_file(self):
         """Attempt to load the provided configuration file. If an error occurs
@@ -348,31 +1413,93 @@ class ConfigurationManager(object):
             self.write_default_config_values()
 
         with open(self.config_file_path, "r") as openConfigFile:
-            self.config_file_dict = yaml.load(openConfigFile.read())
+            configMtime = os.fstat(openConfigFile.fileno()).st_mtime_ns
+            configFileDict = yaml_load(openConfigFile.read()) or {}
+
+        self.snapshot = ConfigSnapshot(
+            self.default_config, configFileDict, vars(self.argNamespace), configMtime
+        )
+        self.config_file_dict = configFileDict
+
+    def get_snapshot(self):
+        """ Returns the current snapshot, resolving one without a file if none
+        was loaded """
+        if self.snapshot is None:
+            self.snapshot = ConfigSnapshot(
+                self.default_config, self.config_file_dict, vars(self.argNamespace)
+            )
+        return self.snapshot
+
+    def refresh(self):
+        """Reloads the configuration file if its mtime changed since it was
+        loaded. A file that fails to load is reported and the current snapshot
+        is kept, so a half-saved edit does not stop a running sweeper.
+
+        Return:
+        True if a new snapshot was loaded
+        """
+        if self.snapshot is None or self.snapshot.configMtime is None:
+            return False
+
+        try:
+            configMtime = os.stat(self.config_file_path).st_mtime_ns
+        except OSError:
+            return False
+        if configMtime == self.snapshot.configMtime:
+            return False
+
+        try:
+            self.load_config_file()
+        except Exception as exception:
+            print(
+                "Error reloading {0}: {1}".format(self.config_file_path, exception)
+            )
+            return False
+        return True
 
     def get_option_value(self, key):
         """Returns the value of the provided option key. The values stored in
         commandline args take precedence over config file"""
-        argDictionary = vars(self.argNamespace)
-        return (
-            argDictionary[key]
-            if key in argDictionary
-            else self.config_file_dict[key]
-            if key in self.config_file_dict
-            else self.default_config[key]
-        )
+        return self.get_snapshot().options[key]
+
+
+RECORD_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+
+
+def record_time_to_epoch(recordTime):
+    """Converts a record time to epoch seconds. Records written by older
+    versions hold ctime strings instead of numbers"""
+    if isinstance(recordTime, (int, float)):
+        return int(recordTime)
+    return int(time.mktime(time.strptime(recordTime, RECORD_TIME_FORMAT)))
+
+
+def missing_paths(recordedPaths, scannedPaths, unlistedDirectories=()):
+    """Returns the recorded paths a tier scan did not find, which are gone or
+    no longer in a tier directory. Paths in unlistedDirectories, which the
+    scan could not list, are never missing"""
+    return [
+        filePath
+        for filePath in recordedPaths
+        if filePath not in scannedPaths
+        and os.path.dirname(filePath) not in unlistedDirectories
+    ]
 
 
 class FileRecordKeeper(object):
     """Keeps track of while files have been moved, where they have been moved
     to, and on what date/time they have been moved"""
 
+    COMPRESSIBILITY_KEY = "compressibility"
+
     def __init__(self, configPath):
         self.recordFileLocation = configPath
         self.records = {}  # movLoc: {Filepath: movDate}
+        self.compressibility = {}  # Filepath: [inode, mtime, compressible]
 
-    def load_existing_records(self):
-        """ Loads the existing records from the record file """
+    def load_existing_records(self, readOnly=False):
+        """Loads the existing records from the record file, which is only
+        ever read here, so readOnly changes nothing"""
         if not os.path.isfile(self.recordFileLocation):
             self.records = {
                 ConfigKeyTranslator.ARCHIVES: {},
@@ -381,14 +1508,24 @@ class FileRecordKeeper(object):
             return
 
         with open(self.recordFileLocation, "r") as openRecordFile:
-            retrievedFileContents = yaml.load(openRecordFile.read())
+            retrievedFileContents = yaml_load(openRecordFile.read())
             if retrievedFileContents is not None:
-                self.records = retrievedFileContents
+                self.compressibility = (
+                    retrievedFileContents.pop(self.COMPRESSIBILITY_KEY, None) or {}
+                )
+                self.records = {
+                    movLocation: {
+                        filePath: record_time_to_epoch(moveDate)
+                        for filePath, moveDate in (tierRecords or {}).items()
+                    }
+                    for movLocation, tierRecords in retrievedFileContents.items()
+                }
 
     def add_record(self, filePath, moveLocation, moveDate):
         if not str(moveLocation) in self.records:
             self.records[str(moveLocation)] = {}
         self.records[str(moveLocation)][filePath] = moveDate
+        JOURNAL.record("add", moveLocation, filePath, moveDate)
 
     def get_filepaths_in_type(self, movLocationType):
         if str(movLocationType) in self.records:
@@ -397,196 +1534,3724 @@ class FileRecordKeeper(object):
             return []
 
     def record_exists(self, movLocation, filePath):
-        mov_records = self.records[str(movLocation)]
+        mov_records = self.records.get(str(movLocation), {})
         return str(movLocation) in self.records and filePath in mov_records
 
     def get_record(self, movLocation, filePath):
         return self.records[str(movLocation)][filePath]
 
+    def earliest_record(self, movLocation):
+        """ Returns the earliest move date recorded in a tier, or None """
+        return min(self.records.get(str(movLocation), {}).values(), default=None)
+
     def delete_record(self, filePath, moveLoc):
         del self.records[str(moveLoc)][filePath]
+        JOURNAL.record("delete", moveLoc, filePath)
+
+    def get_compressibility(self, filePath, inode, mtime):
+        """Returns the cached compressibility of a file, or None if it was never
+        probed or has changed since"""
+        cachedProbe = self.compressibility.get(filePath)
+        if cachedProbe is None or cachedProbe[:2] != [inode, mtime]:
+            return None
+        return cachedProbe[2]
+
+    def set_compressibility(self, filePath, inode, mtime, compressible):
+        self.compressibility[filePath] = [inode, mtime, compressible]
+        JOURNAL.record(
+            "compressibility", None, filePath, [inode, mtime, compressible]
+        )
 
-    def clean_records(self):
-        badRecords = []
-        for movLocation in self.records:
-            for filePath in self.records[movLocation]:
-                if not os.path.exists(filePath):
-                    badRecords.append((filePath, movLocation))
+    def reconcile_records(self, tierPaths, unlistedDirectories=(), moveDate=None):
+        """Makes the records match a scan of the tiers, as described by
+        missing_paths, and records untracked entries as moved at moveDate
+        (now by default). Probe results of paths no longer archived are
+        dropped as well"""
+        moveDate = int(time.time()) if moveDate is None else moveDate
+        for movLocation, scannedPaths in tierPaths.items():
+            tierRecords = self.records.setdefault(str(movLocation), {})
+            for filePath in missing_paths(
+                tierRecords, scannedPaths, unlistedDirectories
+            ):
+                del tierRecords[filePath]
+                JOURNAL.record("delete", movLocation, filePath)
+            for filePath in scannedPaths.difference(tierRecords):
+                tierRecords[filePath] = moveDate
+                JOURNAL.record("add", movLocation, filePath, moveDate)
 
-        for badRecord in badRecords:
-            self.delete_record(badRecord[0], badRecord[1])
+        for filePath in missing_paths(
+            self.compressibility,
+            tierPaths.get(ConfigKeyTranslator.ARCHIVES, set()),
+            unlistedDirectories,
+        ):
+            del self.compressibility[filePath]
 
     def write_records(self):
+        """Writes the records to a temporary file that is renamed over the
+        records file once it is on disk, so the records file always holds a
+        complete set of records, old or new"""
         assert_dir_exists(os.path.dirname(self.recordFileLocation))
-        with open(self.recordFileLocation, "w+") as openRecordFile:
-            openRecordFile.write(yaml.dump(self.records))
+        fileContents = dict(self.records)
+        if self.compressibility:
+            fileContents[self.COMPRESSIBILITY_KEY] = self.compressibility
+        temporaryPath = "{}.{}.tmp".format(self.recordFileLocation, os.getpid())
+        try:
+            with open(temporaryPath, "w+") as openRecordFile:
+                openRecordFile.write(yaml_dump(fileContents))
+                openRecordFile.flush()
+                os.fsync(openRecordFile.fileno())
+            os.replace(temporaryPath, self.recordFileLocation)
+        except BaseException:
+            if os.path.lexists(temporaryPath):
+                os.unlink(temporaryPath)
+            raise
+        fsync_directory(os.path.dirname(os.path.abspath(self.recordFileLocation)))
 
 
-def move_file_to_path(path, file):
-    if not os.path.isdir(path):
-        os.mkdir(path)
-    newFilePath = os.path.join(path, file.filename)
+class SQLiteRecordKeeper(object):
+    """Keeps the same records as FileRecordKeeper in an SQLite database keyed
+    on (tier, path). Every change is committed as it is made, so nothing has
+    to be loaded or rewritten as a whole"""
 
-    oldFileDetails = os.stat(file.path)
-    oldUid = oldFileDetails.st_uid
-    oldGid = oldFileDetails.st_gid
-    shutil.move(file.path, newFilePath)
+    def __init__(self, databasePath, legacyRecordPath=None):
+        self.recordFileLocation = databasePath
+        self.legacyRecordFileLocation = legacyRecordPath
+        self.connection = None
 
-    newFileDetails = os.stat(newFilePath)
-    newUid = newFileDetails.st_uid
-    newGid = newFileDetails.st_gid
+    def load_existing_records(self, readOnly=False):
+        """Opens the record database, creating it and migrating the legacy
+        YAML records into it if it does not exist yet. The schema and the
+        migrated records are committed together, so a migration that fails is
+        tried again by the next run. With readOnly, an existing database is
+        opened read-only, and a missing one is created and migrated into in
+        memory, so nothing on disk changes"""
+        import sqlite3
 
-    if newUid != oldUid or newGid != oldUid:
-        try:
-            os.chown(newFilePath, oldUid, oldGid)
-        except AttributeError:
-            pass
+        if readOnly and os.path.isfile(self.recordFileLocation):
+            from urllib.parse import quote
 
-    return newFilePath
+            self.connection = sqlite3.connect(
+                "file:{}?mode=ro".format(
+                    quote(os.path.abspath(self.recordFileLocation))
+                ),
+                uri=True,
+            )
+            if self.has_schema():
+                return
+            self.connection.close()
 
+        if readOnly:
+            self.connection = sqlite3.connect(":memory:")
+        else:
+            assert_dir_exists(os.path.dirname(self.recordFileLocation))
+            self.connection = sqlite3.connect(self.recordFileLocation)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        if self.has_schema():
+            return
 
-def move_downloads_to_archive(sweeper, configurationManager, recordKeeper):
-    if not configurationManager.get_option_value("archive_downloads"):
-        return
-    downloadConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.DOWNLOADS)
-    archiveConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.ARCHIVES)
-    staleFiles = sweeper.get_stale_file_paths(downloadConfigTranslator, recordKeeper)
+        # DDL does not open a transaction on its own
+        self.connection.execute("BEGIN")
+        try:
+            self.connection.execute(
+                """CREATE TABLE records (
+                    tier TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    moved_at INTEGER NOT NULL,
+                    PRIMARY KEY (tier, path)
+                ) WITHOUT ROWID"""
+            )
+            self.connection.execute(
+                """CREATE TABLE compressibility (
+                    path TEXT PRIMARY KEY,
+                    inode INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    compressible INTEGER NOT NULL
+                ) WITHOUT ROWID"""
+            )
+            self.migrate_legacy_records()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+
+    def has_schema(self):
+        """ Whether the record tables, which are created last, exist """
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = 'compressibility'"
+            ).fetchone()
+            is not None
+        )
 
-    for file in staleFiles:
-        for archivePath in configurationManager.get_option_value(
-            archiveConfigTranslator.path_key
+    def migrate_legacy_records(self):
+        """Copies every record from the legacy YAML records file, if any, in
+        the transaction that creates the schema"""
+        if self.legacyRecordFileLocation is None or not os.path.isfile(
+            self.legacyRecordFileLocation
         ):
-            try:
-                archivedFilePath = move_file_to_path(archivePath, file)
-            except:
-                print("Error moving {0} to archives".format(file.path))
-                continue
+            return
+
+        legacyRecords = FileRecordKeeper(self.legacyRecordFileLocation)
+        legacyRecords.load_existing_records()
+        rows = [
+            (str(movLocation), filePath, moveDate)
+            for movLocation, tierRecords in legacyRecords.records.items()
+            for filePath, moveDate in tierRecords.items()
+        ]
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?)", rows
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO compressibility VALUES (?, ?, ?, ?)",
+            [
+                (filePath, inode, mtime, compressible)
+                for filePath, (
+                    inode,
+                    mtime,
+                    compressible,
+                ) in legacyRecords.compressibility.items()
+            ],
+        )
+
+    def add_record(self, filePath, moveLocation, moveDate):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?)",
+                (str(moveLocation), filePath, record_time_to_epoch(moveDate)),
+            )
 
-            recordKeeper.add_record(
-                archivedFilePath, ConfigKeyTranslator.ARCHIVES, time.ctime()
+    def get_filepaths_in_type(self, movLocationType):
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT path FROM records WHERE tier = ?", (str(movLocationType),)
             )
+        ]
 
-            if not configurationManager.get_option_value("move_to_all_archive_dirs"):
-                break
+    def earliest_record(self, movLocation):
+        """ Returns the earliest move date recorded in a tier, or None """
+        return self.connection.execute(
+            "SELECT MIN(moved_at) FROM records WHERE tier = ?", (str(movLocation),)
+        ).fetchone()[0]
 
+    def record_exists(self, movLocation, filePath):
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM records WHERE tier = ? AND path = ?",
+                (str(movLocation), filePath),
+            ).fetchone()
+            is not None
+        )
 
-def move_archives_to_purge(sweeper, configurationManager, recordKeeper):
-    if not configurationManager.get_option_value("purge_archives"):
-        return
-    archiveConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.ARCHIVES)
-    purgeConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.PURGES)
-    staleFiles = sweeper.get_stale_file_paths(archiveConfigTranslator, recordKeeper)
+    def get_record(self, movLocation, filePath):
+        row = self.connection.execute(
+            "SELECT moved_at FROM records WHERE tier = ? AND path = ?",
+            (str(movLocation), filePath),
+        ).fetchone()
+        if row is None:
+            raise KeyError(filePath)
+        return row[0]
 
-    for file in staleFiles:
-        for purgePath in configurationManager.get_option_value(
-            purgeConfigTranslator.path_key
-        ):
-            recordKeeper.delete_record(file.path, ConfigKeyTranslator.ARCHIVES)
-            try:
-                purgedFilePath = move_file_to_path(purgePath, file)
-            except:
-                print("Error moving {0} to purge".format(file.path))
-                continue
+    def delete_record(self, filePath, moveLoc):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM records WHERE tier = ? AND path = ?",
+                (str(moveLoc), filePath),
+            )
+
+    def get_compressibility(self, filePath, inode, mtime):
+        """Returns the cached compressibility of a file, or None if it was never
+        probed or has changed since"""
+        row = self.connection.execute(
+            "SELECT compressible FROM compressibility "
+            "WHERE path = ? AND inode = ? AND mtime = ?",
+            (filePath, inode, mtime),
+        ).fetchone()
+        return None if row is None else bool(row[0])
 
-            recordKeeper.add_record(
-                purgedFilePath, ConfigKeyTranslator.PURGES, time.ctime()
+    def set_compressibility(self, filePath, inode, mtime, compressible):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO compressibility VALUES (?, ?, ?, ?)",
+                (filePath, inode, mtime, int(compressible)),
             )
-            if not configurationManager.get_option_value("move_to_all_purge_dirs"):
-                break
 
+    def reconcile_records(self, tierPaths, unlistedDirectories=(), moveDate=None):
+        """ Does what FileRecordKeeper.reconcile_records does in one transaction """
+        moveDate = int(time.time()) if moveDate is None else moveDate
+        badRecords, newRecords = [], []
+        for movLocation, scannedPaths in tierPaths.items():
+            recordedPaths = set(self.get_filepaths_in_type(movLocation))
+            badRecords.extend(
+                (str(movLocation), filePath)
+                for filePath in missing_paths(
+                    recordedPaths, scannedPaths, unlistedDirectories
+                )
+            )
+            newRecords.extend(
+                (str(movLocation), filePath, moveDate)
+                for filePath in scannedPaths.difference(recordedPaths)
+            )
+        probedPaths = [
+            filePath
+            for (filePath,) in self.connection.execute(
+                "SELECT path FROM compressibility"
+            )
+        ]
+        badProbes = [
+            (filePath,)
+            for filePath in missing_paths(
+                probedPaths,
+                tierPaths.get(ConfigKeyTranslator.ARCHIVES, set()),
+                unlistedDirectories,
+            )
+        ]
 
-def delete_from_purge(sweeper, configurationMangager, recordKeeper):
-    purgeConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.PURGES)
-    staleFiles = sweeper.get_stale_file_paths(purgeConfigTranslator, recordKeeper)
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM records WHERE tier = ? AND path = ?", badRecords
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?)", newRecords
+            )
+            self.connection.executemany(
+                "DELETE FROM compressibility WHERE path = ?", badProbes
+            )
+
+    def write_records(self):
+        """ Records are committed as they change, so there is nothing to write """
+        self.connection.commit()
 
-    # Delete all stale purge files
-    for file in staleFiles:
-        remove_path(file.path)
 
+def create_record_keeper(configurationManager, parsedArgs):
+    """ Creates the record keeper for the configured record backend """
+    backend = configurationManager.get_option_value("record_backend")
+    if backend == "yaml":
+        return FileRecordKeeper(parsedArgs.records)
+    elif backend == "sqlite":
+        return SQLiteRecordKeeper(parsedArgs.records_db, parsedArgs.records)
 
-def is_zip_extension(extension):
-    return extension in [".zip"]
+    raise ConfigurationManager.ConfigurationException(
+        "{} is an invalid record backend".format(backend)
+    )
 
 
-def zip_path(filePath):
-    zipPath = "{}.zip".format(filePath)
-    with ZipFile(zipPath, "w") as zipFile:
-        zipFile.write(filePath)
-    return zipPath
+def archived_member_path(originalPath, member):
+    """Returns where a member of the archive of originalPath was before it was
+    archived. Members are named after the entry the archive was made from, so
+    their first component stands for originalPath"""
+    if not member:
+        return originalPath
+    topName, separator, rest = member.rstrip("/").partition("/")
+    return os.path.join(originalPath, rest) if rest else originalPath
 
 
-def remove_path(path):
-    if os.path.isfile(path):
-        os.remove(path)
-    else:
-        shutil.rmtree(path)
+class ArchiveIndex(object):
+    """Maps every archived file to the archive, and the member in it, that
+    holds it, by original path, basename, size and hash. Entries archived as
+    they are have a single row with an empty member, which is replaced by a
+    row per file, directory and symlink once they are compressed, each noting
+    whether the archive holds a tarball. Every lookup is answered from an
+    SQLite index, so it takes O(log n) however many archives there are.
+    Updates are ignored until the index is opened"""
 
+    def __init__(self):
+        self.connection = None
 
-def compress_archive_files(configurationManager, recordKeeper):
-    # For now there will be no compression method available except for ZIP
-    for filePath in recordKeeper.get_filepaths_in_type(ConfigKeyTranslator.ARCHIVES)[:]:
-        fileExtension = os.path.splitext(filePath)[1]
-        if not is_zip_extension(fileExtension):
-            try:
-                zipPath = zip_path(filePath)
-                remove_path(filePath)
-                recordedDatetime = recordKeeper.get_record(
-                    ConfigKeyTranslator.ARCHIVES, filePath
+    def open(self, databasePath):
+        assert_dir_exists(os.path.dirname(databasePath))
+
+        import sqlite3
+
+        self.connection = sqlite3.connect(databasePath)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS archived (
+                    archive_path TEXT NOT NULL,
+                    member TEXT NOT NULL,
+                    original_path TEXT NOT NULL,
+                    basename TEXT NOT NULL,
+                    size INTEGER,
+                    hash TEXT,
+                    tarball INTEGER,
+                    UNIQUE (archive_path, member)
+                )"""
+            )
+            columns = [
+                row[1] for row in self.connection.execute("PRAGMA table_info(archived)")
+            ]
+            if "tarball" not in columns:
+                # Indexes made before it was kept fall back to guessing it
+                self.connection.execute(
+                    "ALTER TABLE archived ADD COLUMN tarball INTEGER"
                 )
-                recordKeeper.delete_record(filePath, ConfigKeyTranslator.ARCHIVES)
-                recordKeeper.add_record(
-                    zipPath, ConfigKeyTranslator.ARCHIVES, recordedDatetime
+            for column in ("original_path", "basename", "hash"):
+                self.connection.execute(
+                    "CREATE INDEX IF NOT EXISTS archived_{0} ON archived ({0})".format(
+                        column
+                    )
                 )
-            except Exception:
-                continue
 
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
-def load_untracked_archives_into_record(sweeper, records):
-    archiveConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.ARCHIVES)
-    archivedFiles, archivedDirs = sweeper.get_all_file_paths(archiveConfigTranslator)
-    add_unknown_files_to_record(
-        ConfigKeyTranslator.ARCHIVES, records, archivedFiles + archivedDirs
-    )
+    def add_archived(self, archivePath, originalPath, size):
+        """ Indexes an entry that was just moved into the archives as it is """
+        if self.connection is None:
+            return
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO archived VALUES (?, '', ?, ?, ?, NULL, NULL)",
+                (
+                    archivePath,
+                    originalPath,
+                    os.path.basename(originalPath.rstrip(os.sep)),
+                    size,
+                ),
+            )
 
+    def original_path(self, archivePath):
+        """Returns where an uncompressed archived entry was archived from, or
+        its own path if it was archived before it was indexed"""
+        row = self.connection.execute(
+            "SELECT original_path FROM archived WHERE archive_path = ? "
+            "AND member = ''",
+            (archivePath,),
+        ).fetchone()
+        return archivePath if row is None else row[0]
 
-def load_untracked_purges_into_record(sweeper, records):
-    purgeConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.PURGES)
-    purgedFiles, purgedDirs = sweeper.get_all_file_paths(purgeConfigTranslator)
-    add_unknown_files_to_record(
-        ConfigKeyTranslator.PURGES, records, purgedFiles + purgedDirs
-    )
+    def replace_with_archive(self, filePath, compressedPath, members, isTarball):
+        """ Indexes the members of the archive filePath was compressed into """
+        if self.connection is None:
+            return
+        originalPath = self.original_path(filePath)
+        rows = []
+        for member, size, hexDigest in members:
+            memberPath = archived_member_path(originalPath, member)
+            rows.append(
+                (
+                    compressedPath,
+                    member,
+                    memberPath,
+                    os.path.basename(memberPath),
+                    size,
+                    hexDigest,
+                    isTarball,
+                )
+            )
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM archived WHERE archive_path = ?",
+                [(filePath,), (compressedPath,)],
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO archived VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
 
+    def holds_tarball(self, archivePath):
+        """Returns whether a compressed archive holds a tarball, or None if it
+        was indexed before that was kept"""
+        row = self.connection.execute(
+            "SELECT tarball FROM archived WHERE archive_path = ? LIMIT 1",
+            (archivePath,),
+        ).fetchone()
+        return None if row is None or row[0] is None else bool(row[0])
 
-def add_unknown_files_to_record(locationType, records, paths):
-    for path in paths:
-        if not records.record_exists(locationType, path):
-            records.add_record(path, locationType, time.ctime())
+    def is_indexed(self, archivePath):
+        if self.connection is None:
+            return False
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM archived WHERE archive_path = ? LIMIT 1",
+                (archivePath,),
+            ).fetchone()
+            is not None
+        )
 
+    def move_archive(self, archivePath, newArchivePaths):
+        """ Points the rows of an archive at the copies it was moved to """
+        if self.connection is None:
+            return
+        with self.connection:
+            for newArchivePath in newArchivePaths:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO archived SELECT ?, member, "
+                    "original_path, basename, size, hash, tarball FROM archived "
+                    "WHERE archive_path = ?",
+                    (newArchivePath, archivePath),
+                )
+            self.connection.execute(
+                "DELETE FROM archived WHERE archive_path = ?", (archivePath,)
+            )
 
-def main():
-    # Parse the arguments
-    parsed_args = argParser.parse_args()
-    configMgr = ConfigurationManager(parsed_args.config, parsed_args)
-    sweeperObj = Sweeper(configMgr)
-    records = FileRecordKeeper(parsed_args.records)
-    records.load_existing_records()
-    records.clean_records()
-    load_untracked_archives_into_record(sweeperObj, records)
-    load_untracked_purges_into_record(sweeperObj, records)
+    def remove_archive(self, archivePath):
+        if self.connection is None:
+            return
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM archived WHERE archive_path = ?", (archivePath,)
+            )
+
+    def reconcile(self, archivePaths, unlistedDirectories=()):
+        """Drops the rows of archives that a scan of the archive and purge
+        tiers, which found archivePaths, did not find"""
+        if self.connection is None:
+            return
+        indexedPaths = [
+            archivePath
+            for (archivePath,) in self.connection.execute(
+                "SELECT DISTINCT archive_path FROM archived"
+            ).fetchall()
+        ]
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM archived WHERE archive_path = ?",
+                [
+                    (archivePath,)
+                    for archivePath in missing_paths(
+                        indexedPaths, archivePaths, unlistedDirectories
+                    )
+                ],
+            )
+
+    def find(self, query):
+        """Returns the rows whose original path is, or is inside, query if it
+        is an absolute path, whose hash is query if it is a hex digest, and
+        whose basename matches query (a glob pattern) otherwise"""
+        columns = (
+            "SELECT original_path, size, archive_path, member, hash FROM archived "
+        )
+        if os.path.isabs(query):
+            path = query.rstrip(os.sep) or os.sep
+            prefix = path.rstrip(os.sep) + os.sep
+            return self.connection.execute(
+                columns + "WHERE original_path = ? "
+                "OR (original_path >= ? AND original_path < ?) "
+                "ORDER BY original_path, archive_path",
+                (path, prefix, prefix[:-1] + chr(ord(os.sep) + 1)),
+            ).fetchall()
+        if re.match(r"^[0-9a-f]{128}$", query):
+            return self.connection.execute(
+                columns + "WHERE hash = ? ORDER BY original_path, archive_path",
+                (query,),
+            ).fetchall()
+        return self.connection.execute(
+            columns + "WHERE basename GLOB ? ORDER BY original_path, archive_path",
+            (query,),
+        ).fetchall()
+
+
+ARCHIVE_INDEX = ArchiveIndex()
+
+
+class OperationJournal(object):
+    """Appends every record change, and every move or compression before it is
+    made and once it is done, to a JSON lines file, so that an interrupted
+    run leaves behind what it did and what it was doing. Every entry is
+    written straight to the kernel, so it survives the process being killed,
+    and fsynced in batches of SYNC_BATCH, or sooner through sync, so it
+    survives a power loss. The journal is emptied once the records it
+    describes are written. Entries are ignored until the journal is opened"""
+
+    SYNC_BATCH = 256
+
+    def __init__(self):
+        self.journalFd = None
+        self.unsyncedCount = 0
+        self.lastOperationId = 0
+
+    @staticmethod
+    def read(journalPath):
+        """Returns the entries of a journal. A torn last line, left by a crash
+        in the middle of a write, ends the journal"""
+        entries = []
+        try:
+            with open(journalPath, "r") as journalFile:
+                for line in journalFile:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+        except OSError:
+            pass
+        return entries
+
+    @staticmethod
+    def is_empty(journalPath):
+        try:
+            return os.stat(journalPath).st_size == 0
+        except OSError:
+            return True
+
+    def open(self, journalPath):
+        assert_dir_exists(os.path.dirname(os.path.abspath(journalPath)))
+        self.journalFd = os.open(
+            journalPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
+        self.unsyncedCount = 0
+
+    def close(self):
+        if self.journalFd is not None:
+            self.sync()
+            os.close(self.journalFd)
+            self.journalFd = None
+
+    def append(self, entry):
+        if self.journalFd is None:
+            return
+        # One write per entry, so a killed process leaves whole lines behind
+        os.write(
+            self.journalFd,
+            (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8"),
+        )
+        self.unsyncedCount += 1
+        if self.unsyncedCount >= self.SYNC_BATCH:
+            self.sync()
+
+    def sync(self):
+        if self.journalFd is None or not self.unsyncedCount:
+            return
+        os.fsync(self.journalFd)
+        self.unsyncedCount = 0
+
+    def record(self, change, movLocation, filePath, value=None):
+        """ Journals a record change: an add, a delete or a compressibility """
+        self.append(
+            {
+                "record": change,
+                "tier": None if movLocation is None else str(movLocation),
+                "path": filePath,
+                "value": value,
+            }
+        )
+
+    def intend(self, action, source, destinations, **details):
+        """Journals an operation that is about to run and returns its id, to be
+        passed to finish once it is done"""
+        if self.journalFd is None:
+            return None
+        self.lastOperationId += 1
+        entry = dict(details)
+        entry.update(
+            intent=self.lastOperationId,
+            action=action,
+            source=source,
+            destinations=destinations,
+            time=int(time.time()),
+        )
+        self.append(entry)
+        return self.lastOperationId
+
+    def finish(self, operationId):
+        if operationId is not None:
+            self.append({"done": operationId})
+
+    def truncate(self):
+        """ Empties the journal once everything in it is in the records """
+        if self.journalFd is None:
+            return
+        os.ftruncate(self.journalFd, 0)
+        os.fsync(self.journalFd)
+        self.unsyncedCount = 0
+
+
+JOURNAL = OperationJournal()
+
+
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+KERNEL_COPY_FALLBACK_ERRNOS = (
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+)
+
+
+def preserve_ownership(oldFileDetails, newFilePath):
+    newFileDetails = os.lstat(newFilePath)
+    oldUid = oldFileDetails.st_uid
+    oldGid = oldFileDetails.st_gid
+
+    if newFileDetails.st_uid != oldUid or newFileDetails.st_gid != oldGid:
+        try:
+            os.chown(newFilePath, oldUid, oldGid, follow_symlinks=False)
+        except (AttributeError, PermissionError):
+            pass
 
-    if configMgr.get_option_value("archive_downloads"):
-        move_downloads_to_archive(sweeperObj, configMgr, records)
 
-    if configMgr.get_option_value("compress_archives"):
-        compress_archive_files(configMgr, records)
+def kernel_copy_range(method, sourceFd, destinationFd, offset, count):
+    """ Copies count bytes of the source at offset without reading them into
+    userspace, appending them at the destination's current position """
+    copied = 0
+    while copied < count:
+        if method == "copy_file_range":
+            chunkCopied = os.copy_file_range(
+                sourceFd, destinationFd, count - copied, offset + copied
+            )
+        else:
+            chunkCopied = os.sendfile(
+                destinationFd, sourceFd, offset + copied, count - copied
+            )
+        if chunkCopied == 0:
+            raise IOError(errno.EIO, "Source changed while being copied")
+        copied += chunkCopied
+
+
+def copy_fd_to_all(sourceFd, destinationFds, size):
+    """Copies size bytes of the source to every destination. Each destination
+    uses copy_file_range, then sendfile, so the data stays in the kernel and
+    the source is read from disk once. Destinations that support neither share
+    a single userspace read of every chunk"""
+    kernelMethods = [
+        method for method in ("copy_file_range", "sendfile") if hasattr(os, method)
+    ]
+    destinationMethods = {fd: list(kernelMethods) for fd in destinationFds}
+
+    offset = 0
+    while offset < size:
+        count = min(TRANSFER_CHUNK_SIZE, size - offset)
+        THROTTLE.use_bytes(count * (len(destinationFds) + 1))
+        chunk = None
+        for destinationFd in destinationFds:
+            methods = destinationMethods[destinationFd]
+            while methods:
+                try:
+                    kernel_copy_range(
+                        methods[0], sourceFd, destinationFd, offset, count
+                    )
+                    break
+                except OSError as exception:
+                    if exception.errno not in KERNEL_COPY_FALLBACK_ERRNOS:
+                        raise
+                    methods.pop(0)
+                    os.lseek(destinationFd, offset, os.SEEK_SET)
+            else:
+                if chunk is None:
+                    chunk = os.pread(sourceFd, count, offset)
+                    if len(chunk) != count:
+                        raise IOError(errno.EIO, "Source changed while being copied")
+                written = 0
+                while written < count:
+                    written += os.write(destinationFd, memoryview(chunk)[written:])
+
+        offset += count
+
 
-    if configMgr.get_option_value("purge_archives"):
-        move_archives_to_purge(sweeperObj, configMgr, records)
+def copy_file_to_all(sourcePath, destinationPaths):
+    """ Copies a regular file, its permissions, times and owner to every
+    destination """
+    with open(sourcePath, "rb") as sourceFile:
+        sourceDetails = os.fstat(sourceFile.fileno())
+        destinationFiles = []
+        try:
+            for destinationPath in destinationPaths:
+                destinationFiles.append(open(destinationPath, "wb"))
+            copy_fd_to_all(
+                sourceFile.fileno(),
+                [destinationFile.fileno() for destinationFile in destinationFiles],
+                sourceDetails.st_size,
+            )
+        finally:
+            for destinationFile in destinationFiles:
+                destinationFile.close()
+
+    import shutil
+
+    for destinationPath in destinationPaths:
+        shutil.copystat(sourcePath, destinationPath)
+        preserve_ownership(sourceDetails, destinationPath)
 
-    if configMgr.get_option_value("delete_from_purge"):
-        delete_from_purge(sweeperObj, configMgr, records)
 
-    records.write_records()
+def copy_tree_to_all(sourcePath, destinationPaths):
+    """ Copies a directory tree to every destination, copying each file in it
+    with copy_file_to_all """
+    import shutil
+
+    copiedDirectories = [(sourcePath, destinationPaths)]
+    for destinationPath in destinationPaths:
+        os.mkdir(destinationPath)
+
+    for root, dirs, files in os.walk(sourcePath):
+        relativeRoot = os.path.relpath(root, sourcePath)
+        targetRoots = [
+            os.path.normpath(os.path.join(destinationPath, relativeRoot))
+            for destinationPath in destinationPaths
+        ]
+        for name in dirs + files:
+            entryPath = os.path.join(root, name)
+            entryDetails = os.lstat(entryPath)
+            targetPaths = [os.path.join(targetRoot, name) for targetRoot in targetRoots]
+            if stat.S_ISLNK(entryDetails.st_mode):
+                linkTarget = os.readlink(entryPath)
+                for targetPath in targetPaths:
+                    os.symlink(linkTarget, targetPath)
+                    preserve_ownership(entryDetails, targetPath)
+            elif stat.S_ISDIR(entryDetails.st_mode):
+                for targetPath in targetPaths:
+                    os.mkdir(targetPath)
+                copiedDirectories.append((entryPath, targetPaths))
+            elif stat.S_ISREG(entryDetails.st_mode):
+                copy_file_to_all(entryPath, targetPaths)
+            else:
+                raise IOError(
+                    errno.EINVAL, "Cannot copy special file {}".format(entryPath)
+                )
+
+    # Directory times are copied last, after their contents stopped changing
+    for directoryPath, targetPaths in reversed(copiedDirectories):
+        directoryDetails = os.lstat(directoryPath)
+        for targetPath in targetPaths:
+            shutil.copystat(directoryPath, targetPath)
+            preserve_ownership(directoryDetails, targetPath)
+
+
+PARTIAL_COPY_PREFIX = ".download-sweeper-copying."
+
+
+def partial_copy_path(destinationPath):
+    """Returns the temporary path a copy to destinationPath is made under,
+    which is the same every time so an interrupted copy can be found again"""
+    import hashlib
+
+    digest = hashlib.blake2b(os.fsencode(destinationPath), digest_size=16)
+    return os.path.join(
+        os.path.dirname(destinationPath), PARTIAL_COPY_PREFIX + digest.hexdigest()
+    )
+
+
+def copy_into_place(sourcePath, destinationPaths):
+    """Copies a file, symlink or directory tree to every destination. The
+    copies are made under temporary names and only renamed into place once
+    all of them are complete, so a copy cut short is never left under its
+    final name. If one fails, every copy is removed"""
+    sourceDetails = os.lstat(sourcePath)
+    partialPaths = [
+        partial_copy_path(destinationPath) for destinationPath in destinationPaths
+    ]
+    placedPaths = []
+    try:
+        for partialPath in partialPaths:
+            if os.path.lexists(partialPath):
+                remove_path(partialPath)  # Left behind by an interrupted move
+
+        if stat.S_ISDIR(sourceDetails.st_mode):
+            copy_tree_to_all(sourcePath, partialPaths)
+        elif stat.S_ISLNK(sourceDetails.st_mode):
+            for partialPath in partialPaths:
+                os.symlink(os.readlink(sourcePath), partialPath)
+        else:
+            copy_file_to_all(sourcePath, partialPaths)
+
+        for partialPath, destinationPath in zip(partialPaths, destinationPaths):
+            THROTTLE.use_operation()
+            os.rename(partialPath, destinationPath)
+            placedPaths.append(destinationPath)
+    except BaseException:
+        for path in partialPaths + placedPaths:
+            if os.path.lexists(path):
+                remove_path(path)
+        raise
+
+
+def move_file_to_paths(paths, file):
+    """Moves a file or directory into every directory in paths. It is renamed
+    into one directory on its own filesystem, if there is one, and copied into
+    the rest while being read only once. The source is removed only after all
+    copies succeed; if one fails, the copies made so far are removed.
+
+    Return:
+    [newFilePath] in the same order as paths
+    """
+    if not paths:
+        raise ValueError("No destination to move {} to".format(file.path))
+
+    sourceDetails = os.lstat(file.path)
+    isDir = stat.S_ISDIR(sourceDetails.st_mode)
+    newFilePaths, renamePath = [], None
+    for path in paths:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        newFilePath = os.path.join(path, file.filename)
+        if isDir and os.path.lexists(newFilePath):
+            raise IOError(errno.EEXIST, "{} already exists".format(newFilePath))
+        if renamePath is None and os.stat(path).st_dev == sourceDetails.st_dev:
+            renamePath = newFilePath
+        newFilePaths.append(newFilePath)
+
+    copyPaths = [
+        newFilePath for newFilePath in newFilePaths if newFilePath != renamePath
+    ]
+    if renamePath is not None:
+        THROTTLE.use_operation()
+        try:
+            os.rename(file.path, renamePath)
+        except OSError as exception:
+            if exception.errno != errno.EXDEV:
+                raise
+            copyPaths.append(renamePath)
+            renamePath = None
+
+    try:
+        if copyPaths:
+            copy_into_place(
+                file.path if renamePath is None else renamePath, copyPaths
+            )
+    except BaseException:
+        if renamePath is not None:
+            os.rename(renamePath, file.path)
+        raise
+
+    if renamePath is None:
+        remove_path(file.path)
+
+    return newFilePaths
+
+
+def move_file_to_tier(file, paths, moveToAll, tierName):
+    """Moves a file into every directory of a tier, or into the first one that
+    accepts it if moveToAll is false. Every failed attempt is reported.
+
+    Return:
+    [newFilePath] for every directory the file was moved into
+    """
+    destinationGroups = [paths] if moveToAll else [[path] for path in paths]
+    for destinationPaths in destinationGroups:
+        if not destinationPaths:
+            continue
+        try:
+            return move_file_to_paths(destinationPaths, file)
+        except Exception as exception:
+            METRICS.count("errors")
+            print(
+                "Error moving {0} to {1}: {2}".format(file.path, tierName, exception)
+            )
+
+    return []
+
+
+def device_of(path):
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+OPERATION_WINDOW = 4096
+
+
+def disk_order(operation):
+    """Sorts operations by device and inode, which roughly follows the layout
+    of their sources on disk and so keeps seeks down"""
+    return operation.get("device") or 0, operation.get("inode") or 0
+
+
+def sorted_in_windows(operations, window=OPERATION_WINDOW):
+    """Yields operations in disk_order within consecutive windows of window
+    operations. That saves most of the seeks sorting all of them would, while
+    only one window is held in memory however many operations there are"""
+    from itertools import islice
+
+    operations = iter(operations)
+    while True:
+        batch = sorted(islice(operations, window), key=disk_order)
+        if not batch:
+            return
+        for operation in batch:
+            yield operation
+
+
+class SweepPlan(object):
+    """The operations a sweep will perform, in the order they will run. A plan
+    is serializable, so it can be reviewed with --dry-run and run later with
+    --apply-plan"""
+
+    VERSION = 1
+    ARCHIVE = "archive"
+    COMPRESS = "compress"
+    PURGE = "purge"
+    DELETE = "delete"
+    ACTIONS = (ARCHIVE, COMPRESS, PURGE, DELETE)
+
+    def __init__(self, operations=None, createdTime=None):
+        self.operations = list(operations or [])
+        self.createdTime = time.time() if createdTime is None else createdTime
+
+    def order_operations(self):
+        """ Orders the operations of every phase by disk_order """
+        self.operations.sort(
+            key=lambda operation: (
+                (self.ACTIONS.index(operation["action"]),) + disk_order(operation)
+            )
+        )
+
+    def operations_for(self, action):
+        return [
+            operation for operation in self.operations if operation["action"] == action
+        ]
+
+    def totals(self):
+        totals = {}
+        for action in self.ACTIONS:
+            operations = self.operations_for(action)
+            totals[action] = {
+                "count": len(operations),
+                "bytes": sum(operation["bytes"] for operation in operations),
+                "io_bytes": sum(operation["io_bytes"] for operation in operations),
+            }
+        return totals
+
+    def to_dict(self):
+        return {
+            "version": self.VERSION,
+            "created": self.createdTime,
+            "totals": self.totals(),
+            "operations": self.operations,
+        }
+
+    @classmethod
+    def from_dict(cls, planDict):
+        if planDict.get("version") != cls.VERSION:
+            raise ValueError(
+                "Unsupported plan version {}".format(planDict.get("version"))
+            )
+        return cls(planDict["operations"], planDict["created"])
+
+    def save(self, path):
+        """ Writes the plan as JSON to path, or to stdout if path is "-" """
+        planJson = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        if path == "-":
+            print(planJson)
+            return
+        with open(path, "w+") as planFile:
+            planFile.write(planJson + "\n")
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as planFile:
+            return cls.from_dict(json.load(planFile))
+
+
+class SweepPlanner(object):
+    """Works out the operations of a sweep and what they will cost, without
+    changing anything on disk"""
+
+    def __init__(self, sweeper, configurationManager, recordKeeper):
+        self.sweeper = sweeper
+        self.configurationManager = configurationManager
+        self.recordKeeper = recordKeeper
+        self.devices = {}
+
+    def device_of(self, path):
+        if path not in self.devices:
+            self.devices[path] = device_of(path)
+        return self.devices[path]
+
+    def describe(self, action, file, withSize=True):
+        """Returns the operation for a file, with its size and identity, which
+        are only looked up if the scan did not collect them. Without withSize
+        the size of a directory is left out rather than walked for"""
+        size = getattr(file, "size", None)
+        if getattr(file, "inode", None) is None or size is None:
+            METRICS.count("stat_calls")
+            fileDetails = os.lstat(file.path)
+            device, inode = fileDetails.st_dev, fileDetails.st_ino
+            mtimeNs = fileDetails.st_mtime_ns
+            if size is None and stat.S_ISDIR(fileDetails.st_mode):
+                if withSize:
+                    size = summarize_tree(file.path)[1]
+            elif size is None:
+                size = fileDetails.st_size
+        else:
+            device, inode, mtimeNs = file.device, file.inode, file.mtimeNs
+
+        return {
+            "action": action,
+            "source": file.path,
+            "bytes": size,
+            "io_bytes": 0,
+            "device": device,
+            "inode": inode,
+            "mtime_ns": mtimeNs,
+        }
+
+    def plan_moves(self, action, files, destinationPaths, moveToAll):
+        """ Yields the operation of every file as files come in """
+        if not destinationPaths:
+            return
+
+        plannedDestinations = destinationPaths if moveToAll else destinationPaths[:1]
+        for file in files:
+            try:
+                operation = self.describe(action, file)
+            except OSError:
+                continue
+
+            # The source is renamed into one directory on its own device and
+            # read once for the copies into all the others
+            copies = len(plannedDestinations)
+            if any(
+                self.device_of(path) == operation["device"]
+                for path in plannedDestinations
+            ):
+                copies -= 1
+            operation["destinations"] = list(destinationPaths)
+            operation["move_to_all"] = moveToAll
+            operation["io_bytes"] = operation["bytes"] * (copies + 1) if copies else 0
+            yield operation
+
+    def plan_archive(self, files):
+        return self.plan_moves(
+            SweepPlan.ARCHIVE,
+            files,
+            self.configurationManager.get_option_value("archive_directories"),
+            self.configurationManager.get_option_value("move_to_all_archive_dirs"),
+        )
+
+    def plan_purge(self, files):
+        return self.plan_moves(
+            SweepPlan.PURGE,
+            files,
+            self.configurationManager.get_option_value("purge_directories"),
+            self.configurationManager.get_option_value("move_to_all_purge_dirs"),
+        )
+
+    def plan_deletions(self, files, withSizes=True):
+        """Yields the operation of every file as files come in. Sizes are only
+        needed to report a plan, since the deleter counts what it deletes"""
+        for file in files:
+            try:
+                yield self.describe(SweepPlan.DELETE, file, withSizes)
+            except OSError:
+                continue
+
+    def plan_compression(self, archiveOperations, purgedPaths):
+        """Plans compressing every uncompressed archive that is not about to be
+        purged, including the archives the archive operations will create"""
+        operations = []
+        for filePath in self.recordKeeper.get_filepaths_in_type(
+            ConfigKeyTranslator.ARCHIVES
+        ):
+            if filePath in purgedPaths or is_compressed_extension(
+                os.path.splitext(filePath)[1]
+            ):
+                continue
+
+            try:
+                operation = self.describe(SweepPlan.COMPRESS, File(filePath))
+            except OSError:
+                continue
+            if (
+                self.recordKeeper.get_compressibility(
+                    filePath, operation["inode"], operation["mtime_ns"]
+                )
+                is False
+            ):
+                continue
+            operation["io_bytes"] = operation["bytes"] * 2
+            operations.append(operation)
+
+        for archiveOperation in archiveOperations:
+            archiveFilename = os.path.basename(archiveOperation["source"])
+            destinationPaths = archiveOperation["destinations"]
+            if not archiveOperation["move_to_all"]:
+                destinationPaths = destinationPaths[:1]
+            if is_compressed_extension(os.path.splitext(archiveFilename)[1]):
+                continue
+
+            for destinationPath in destinationPaths:
+                operations.append(
+                    {
+                        "action": SweepPlan.COMPRESS,
+                        "source": os.path.join(destinationPath, archiveFilename),
+                        "bytes": archiveOperation["bytes"],
+                        "io_bytes": archiveOperation["bytes"] * 2,
+                        "device": self.device_of(destinationPath),
+                        "inode": archiveOperation["inode"],
+                        "mtime_ns": None,  # Does not exist until it is archived
+                    }
+                )
+
+        return operations
+
+    def plan_sweep(self):
+        """ Plans every enabled tier operation over every tier directory """
+        operations = []
+        if self.configurationManager.get_option_value("archive_downloads"):
+            operations.extend(
+                self.plan_archive(
+                    self.sweeper.get_stale_file_paths(
+                        ConfigKeyTranslator(ConfigKeyTranslator.DOWNLOADS),
+                        self.recordKeeper,
+                    )
+                )
+            )
+
+        purgeOperations = []
+        if self.configurationManager.get_option_value("purge_archives"):
+            purgeOperations = list(
+                self.plan_purge(
+                    self.sweeper.get_stale_file_paths(
+                        ConfigKeyTranslator(ConfigKeyTranslator.ARCHIVES),
+                        self.recordKeeper,
+                    )
+                )
+            )
+
+        if self.configurationManager.get_option_value("compress_archives"):
+            operations.extend(
+                self.plan_compression(
+                    operations,
+                    set(operation["source"] for operation in purgeOperations),
+                )
+            )
+        operations.extend(purgeOperations)
+
+        if self.configurationManager.get_option_value("delete_from_purge"):
+            operations.extend(
+                self.plan_deletions(
+                    self.sweeper.get_stale_file_paths(
+                        ConfigKeyTranslator(ConfigKeyTranslator.PURGES),
+                        self.recordKeeper,
+                    )
+                )
+            )
+
+        plan = SweepPlan(operations)
+        plan.order_operations()
+        return plan
+
+
+def operation_is_current(operation, downloadCutoff=None):
+    """Whether the source of an operation is still the one that was planned.
+    Sources that did not exist when planning, and sources to compress, which
+    deduplication may have relinked, only need to exist now. Given the stale
+    cutoff of downloads, a download to archive must also not have been
+    accessed since it, the way Sweeper.file_is_stale checks it"""
+    METRICS.count("stat_calls")
+    try:
+        fileDetails = os.lstat(operation["source"])
+    except OSError:
+        return False
+
+    if operation.get("mtime_ns") is None or operation["action"] == SweepPlan.COMPRESS:
+        return True
+    if (fileDetails.st_ino, fileDetails.st_mtime_ns) != (
+        operation["inode"],
+        operation["mtime_ns"],
+    ):
+        return False
+
+    if downloadCutoff is None or operation["action"] != SweepPlan.ARCHIVE:
+        return True
+    lastAccessTime = fileDetails.st_atime
+    if stat.S_ISDIR(fileDetails.st_mode):
+        lastAccessTime = summarize_tree(operation["source"])[0]
+    return lastAccessTime is None or lastAccessTime < downloadCutoff
+
+
+def apply_move(operation, recordKeeper):
+    if operation["action"] == SweepPlan.ARCHIVE:
+        tierName, configType = "archives", ConfigKeyTranslator.ARCHIVES
+    else:
+        tierName, configType = "purge", ConfigKeyTranslator.PURGES
+
+    operationId = JOURNAL.intend(
+        operation["action"],
+        operation["source"],
+        operation["destinations"],
+        move_to_all=operation["move_to_all"],
+        bytes=operation["bytes"],
+    )
+    # Without a durable intent a crash mid-move leaves an unrecorded entry
+    JOURNAL.sync()
+    newFilePaths = move_file_to_tier(
+        File(operation["source"]),
+        operation["destinations"],
+        operation["move_to_all"],
+        tierName,
+    )
+    if not newFilePaths:
+        JOURNAL.finish(operationId)
+        return
+
+    METRICS.count("bytes_moved", operation["bytes"])
+    record_move(
+        recordKeeper,
+        configType,
+        operation["source"],
+        newFilePaths,
+        operation["bytes"],
+        int(time.time()),
+    )
+    JOURNAL.finish(operationId)
+
+
+def record_move(recordKeeper, configType, sourcePath, newFilePaths, size, moveDate):
+    """ Records and indexes an entry that was moved into a tier """
+    if configType == ConfigKeyTranslator.PURGES:
+        ARCHIVE_INDEX.move_archive(sourcePath, newFilePaths)
+        if recordKeeper.record_exists(ConfigKeyTranslator.ARCHIVES, sourcePath):
+            recordKeeper.delete_record(sourcePath, ConfigKeyTranslator.ARCHIVES)
+    for newFilePath in newFilePaths:
+        recordKeeper.add_record(newFilePath, configType, moveDate)
+        if configType == ConfigKeyTranslator.ARCHIVES:
+            ARCHIVE_INDEX.add_archived(newFilePath, sourcePath, size)
+
+
+def apply_delete(operation, recordKeeper, deleter):
+    try:
+        deletedBytes, reclaimedBytes, errorCount = deleter.delete(
+            operation["source"]
+        )
+    except OSError as exception:
+        METRICS.count("errors")
+        print("Error deleting {0}: {1}".format(operation["source"], exception))
+        return
+
+    METRICS.count("bytes_reclaimed", reclaimedBytes)
+    if errorCount:
+        METRICS.count("errors", errorCount)
+    else:
+        METRICS.count("deletions")
+        METRICS.count("bytes_deleted", deletedBytes)
+    # Whatever is left is a tombstone now, which the next sweep retries
+    ARCHIVE_INDEX.remove_archive(operation["source"])
+    if recordKeeper.record_exists(ConfigKeyTranslator.PURGES, operation["source"]):
+        recordKeeper.delete_record(operation["source"], ConfigKeyTranslator.PURGES)
+
+
+def apply_operations(
+    action, operations, configurationManager, recordKeeper, downloadCutoff=None
+):
+    """Runs the operations of one action as they come in, in disk_order within
+    windows. Operations whose source changed since they were planned, or
+    downloads accessed since downloadCutoff if it is given, are skipped.
+    Archives to compress are gathered and compressed together at the end.
+    Returns how many operations were run"""
+    metadataPool = MetadataPool.from_config(configurationManager)
+    deleter = TreeDeleter.from_config(configurationManager)
+    compressPaths, appliedCount = [], 0
+    for operation, isCurrent in metadataPool.imap(
+        lambda operation: operation_is_current(operation, downloadCutoff),
+        sorted_in_windows(operations),
+        lambda operation: operation["source"],
+    ):
+        if not isCurrent:
+            if operation.get("mtime_ns") is not None:
+                print(
+                    "Skipping {0} of {1}, it changed or was accessed since it "
+                    "was planned".format(action, operation["source"])
+                )
+            continue
+
+        appliedCount += 1
+        if action == SweepPlan.COMPRESS:
+            compressPaths.append(operation["source"])
+        elif action == SweepPlan.DELETE:
+            apply_delete(operation, recordKeeper, deleter)
+        else:
+            apply_move(operation, recordKeeper)
+
+    if compressPaths:
+        compress_archive_files(configurationManager, recordKeeper, compressPaths)
+    return appliedCount
+
+
+def apply_plan(plan, configurationManager, recordKeeper, recheckStaleness=False):
+    """Runs the operations of a plan phase by phase. Operations whose source
+    changed since the plan was made are skipped, and with recheckStaleness so
+    are downloads that are no longer stale, for plans made a while ago"""
+    downloadCutoff = None
+    if recheckStaleness:
+        downloadCutoff = Sweeper(configurationManager).get_stale_cutoff(
+            ConfigKeyTranslator(ConfigKeyTranslator.DOWNLOADS)
+        )
+    for action in SweepPlan.ACTIONS:
+        if (
+            action == SweepPlan.COMPRESS
+            and configurationManager.get_option_value("deduplicate_archives")
+            and (
+                plan.operations_for(SweepPlan.ARCHIVE)
+                or plan.operations_for(SweepPlan.COMPRESS)
+            )
+        ):
+            with METRICS.phase("deduplicate"):
+                deduplicate_archive_files(recordKeeper)
+
+        operations = plan.operations_for(action)
+        if operations:
+            with METRICS.phase(action):
+                apply_operations(
+                    action,
+                    operations,
+                    configurationManager,
+                    recordKeeper,
+                    downloadCutoff,
+                )
+
+
+def move_downloads_to_archive(sweeper, configurationManager, recordKeeper):
+    if not configurationManager.get_option_value("archive_downloads"):
+        return
+    downloadConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.DOWNLOADS)
+    staleFiles = sweeper.get_stale_file_paths(downloadConfigTranslator, recordKeeper)
+    archive_files(staleFiles, configurationManager, recordKeeper)
+
+
+def archive_files(files, configurationManager, recordKeeper):
+    planner = SweepPlanner(None, configurationManager, recordKeeper)
+    apply_plan(
+        SweepPlan(planner.plan_archive(files)), configurationManager, recordKeeper
+    )
+
+
+def move_archives_to_purge(sweeper, configurationManager, recordKeeper):
+    if not configurationManager.get_option_value("purge_archives"):
+        return
+    archiveConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.ARCHIVES)
+    staleFiles = sweeper.get_stale_file_paths(archiveConfigTranslator, recordKeeper)
+    purge_files(staleFiles, configurationManager, recordKeeper)
+
+
+def purge_files(files, configurationManager, recordKeeper):
+    planner = SweepPlanner(None, configurationManager, recordKeeper)
+    apply_plan(SweepPlan(planner.plan_purge(files)), configurationManager, recordKeeper)
+
+
+def delete_from_purge(sweeper, configurationMangager, recordKeeper):
+    purgeConfigTranslator = ConfigKeyTranslator(ConfigKeyTranslator.PURGES)
+    staleFiles = sweeper.get_stale_file_paths(purgeConfigTranslator, recordKeeper)
+    delete_files(staleFiles, configurationMangager, recordKeeper)
+
+
+def delete_files(files, configurationManager, recordKeeper):
+    planner = SweepPlanner(None, configurationManager, recordKeeper)
+    apply_plan(
+        SweepPlan(planner.plan_deletions(files, withSizes=False)),
+        configurationManager,
+        recordKeeper,
+    )
+
+
+class CompressionCodec(object):
+    """A compression format archived files can be stored in. Files are
+    compressed into a single stream while directories are archived
+    recursively (as a tarball for the stream-only codecs)"""
+
+    ZIP = "zip"
+    GZIP = "gzip"
+    BZ2 = "bz2"
+    LZMA = "lzma"
+    ZSTD = "zstd"
+
+    # codec: (file extension, directory extension)
+    _extension_list = {
+        ZIP: (".zip", ".zip"),
+        GZIP: (".gz", ".tar.gz"),
+        BZ2: (".bz2", ".tar.bz2"),
+        LZMA: (".xz", ".tar.xz"),
+        ZSTD: (".zst", ".tar.zst"),
+    }
+
+    def __init__(self, codec, level=None):
+        if codec not in self._extension_list:
+            raise ConfigurationManager.ConfigurationException(
+                "{} is an invalid compression codec".format(codec)
+            )
+        if codec == self.ZSTD and import_zstandard() is None:
+            raise ConfigurationManager.ConfigurationException(
+                "The zstd compression codec requires the zstandard package"
+            )
+
+        self.codec = codec
+        self.level = level
+        self.file_extension, self.dir_extension = self._extension_list[codec]
+
+    @classmethod
+    def extensions(cls):
+        return set(
+            extension
+            for extensions in cls._extension_list.values()
+            for extension in extensions
+        )
+
+    @classmethod
+    def of_archive(cls, archivePath):
+        """Returns the codec an archive was written with and whether it holds
+        a tarball, going by its extension, or (None, False) if it has none.
+        Where the archive index knows whether it holds a tarball, that is
+        used instead, as a file named .tar compresses to the same name"""
+        for codec, (fileExtension, dirExtension) in cls._extension_list.items():
+            if archivePath.endswith(dirExtension) and codec != cls.ZIP:
+                return codec, True
+        for codec, (fileExtension, dirExtension) in cls._extension_list.items():
+            if archivePath.endswith(fileExtension):
+                return codec, False
+        return None, False
+
+    def holds_tarball(self, isDir):
+        """ Whether the archive of a file, or of a directory, is a tarball """
+        return isDir and self.codec != self.ZIP
+
+    def compressed_path(self, path):
+        extension = self.dir_extension if os.path.isdir(path) else self.file_extension
+        return "{}{}".format(path.rstrip(os.sep), extension)
+
+    def open_stream(self, rawFile, filename):
+        """ Wraps a binary file object in a compressing writer """
+        if self.codec == self.GZIP:
+            import gzip
+
+            return gzip.GzipFile(
+                filename=filename,
+                mode="wb",
+                fileobj=rawFile,
+                compresslevel=9 if self.level is None else self.level,
+            )
+        elif self.codec == self.BZ2:
+            import bz2
+
+            return bz2.BZ2File(
+                rawFile, "wb", compresslevel=9 if self.level is None else self.level
+            )
+        elif self.codec == self.LZMA:
+            import lzma
+
+            return lzma.LZMAFile(rawFile, "wb", preset=self.level)
+        elif self.codec == self.ZSTD:
+            compressor = import_zstandard().ZstdCompressor(
+                level=3 if self.level is None else self.level
+            )
+            return compressor.stream_writer(rawFile, closefd=False)
+
+        raise ValueError("{} does not compress single streams".format(self.codec))
+
+    def open_reader(self, rawFile):
+        """ Wraps a binary file object in a decompressing reader """
+        if self.codec == self.GZIP:
+            import gzip
+
+            return gzip.GzipFile(mode="rb", fileobj=rawFile)
+        elif self.codec == self.BZ2:
+            import bz2
+
+            return bz2.BZ2File(rawFile, "rb")
+        elif self.codec == self.LZMA:
+            import lzma
+
+            return lzma.LZMAFile(rawFile, "rb")
+        elif self.codec == self.ZSTD:
+            return import_zstandard().ZstdDecompressor().stream_reader(rawFile)
+
+        raise ValueError("{} does not compress single streams".format(self.codec))
+
+    def write_zip_file(self, zipFile, filePath, arcname, members):
+        """ Adds a file to a zip archive, reading it within the I/O budget """
+        import hashlib
+        import shutil
+        from zipfile import ZIP_DEFLATED, ZipInfo
+
+        zipInfo = ZipInfo.from_file(filePath, arcname)
+        zipInfo.compress_type = ZIP_DEFLATED
+        if self.level is not None:
+            if hasattr(ZipInfo, "compress_level"):
+                zipInfo.compress_level = self.level  # Public since Python 3.13
+            else:
+                # Older versions only take an entry's level from the attribute
+                # that ZipFile.write sets as well
+                setattr(zipInfo, "_compresslevel", self.level)
+        digest = hashlib.blake2b()
+        with open(filePath, "rb") as sourceFile:
+            with zipFile.open(zipInfo, "w") as zipEntry:
+                shutil.copyfileobj(
+                    ThrottledReader(sourceFile, digest), zipEntry, 1024 * 1024
+                )
+        members.append((zipInfo.filename, zipInfo.file_size, digest.hexdigest()))
+
+    def write_zip_link(self, zipFile, linkPath, arcname, members):
+        """Adds a symlink to a zip archive as a link, the way tar stores it,
+        rather than following it"""
+        from zipfile import ZipInfo
+
+        linkDetails = os.lstat(linkPath)
+        zipInfo = ZipInfo(
+            arcname,
+            max(time.localtime(linkDetails.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)),
+        )
+        zipInfo.external_attr = (linkDetails.st_mode & 0xFFFF) << 16
+        zipFile.writestr(zipInfo, os.readlink(linkPath))
+        members.append((zipInfo.filename, None, None))
+
+    def write_zip(self, rawFile, path, members):
+        from zipfile import ZIP_DEFLATED, ZipFile
+
+        with ZipFile(
+            rawFile, "w", compression=ZIP_DEFLATED, compresslevel=self.level
+        ) as zipFile:
+            parentPath = os.path.dirname(path.rstrip(os.sep))
+            if not os.path.isdir(path):
+                self.write_zip_file(
+                    zipFile, path, os.path.relpath(path, parentPath), members
+                )
+                return
+
+            for root, dirs, files in os.walk(path):
+                zipFile.write(root, os.path.relpath(root, parentPath))
+                members.append((zipFile.infolist()[-1].filename, None, None))
+                for name in dirs + files:
+                    filePath = os.path.join(root, name)
+                    arcname = os.path.relpath(filePath, parentPath)
+                    if os.path.islink(filePath):
+                        self.write_zip_link(zipFile, filePath, arcname, members)
+                    elif not os.path.isdir(filePath):
+                        self.write_zip_file(zipFile, filePath, arcname, members)
+
+    def write_tar(self, tarFile, path, arcname, members):
+        """Adds a tree to a tar archive the way TarFile.add does, reading its
+        files within the I/O budget. Hardlinked files are stored whole, like
+        zip archives store them, so every member can be restored on its own"""
+        import hashlib
+        import tarfile
+
+        tarInfo = tarFile.gettarinfo(path, arcname)
+        if tarInfo.islnk():
+            tarInfo.type, tarInfo.linkname = tarfile.REGTYPE, ""
+            tarInfo.size = os.lstat(path).st_size
+        if tarInfo.isreg():
+            digest = hashlib.blake2b()
+            with open(path, "rb") as sourceFile:
+                tarFile.addfile(tarInfo, ThrottledReader(sourceFile, digest))
+            members.append((tarInfo.name, tarInfo.size, digest.hexdigest()))
+            return
+
+        tarFile.addfile(tarInfo)
+        members.append((tarInfo.name, None, None))
+        if tarInfo.isdir():
+            for name in sorted(os.listdir(path)):
+                self.write_tar(
+                    tarFile,
+                    os.path.join(path, name),
+                    os.path.join(arcname, name),
+                    members,
+                )
+
+    def write(self, rawFile, path):
+        """Writes the compressed form of path into a binary file object.
+
+        Return:
+        [(member name, size, BLAKE2b hex digest)] of every member in it, with
+        no size or digest for directories and symlinks
+        """
+        members = []
+        if self.codec == self.ZIP:
+            self.write_zip(rawFile, path, members)
+            return members
+
+        import hashlib
+        import shutil
+        import tarfile
+
+        filename = os.path.basename(path.rstrip(os.sep))
+        with self.open_stream(rawFile, filename) as compressedStream:
+            if os.path.isdir(path):
+                with tarfile.open(fileobj=compressedStream, mode="w|") as tarFile:
+                    self.write_tar(tarFile, path, filename, members)
+            else:
+                digest = hashlib.blake2b()
+                with open(path, "rb") as sourceFile:
+                    shutil.copyfileobj(
+                        ThrottledReader(sourceFile, digest),
+                        compressedStream,
+                        1024 * 1024,
+                    )
+                    size = os.fstat(sourceFile.fileno()).st_size
+                members.append((filename, size, digest.hexdigest()))
+        return members
+
+
+def is_compressed_extension(extension):
+    return extension in CompressionCodec.extensions()
+
+
+# (offset, magic bytes) of formats that are already compressed
+INCOMPRESSIBLE_SIGNATURES = (
+    (0, b"PK\x03\x04"),  # zip, jar, apk, docx
+    (0, b"\x1f\x8b"),  # gzip
+    (0, b"BZh"),  # bzip2
+    (0, b"\xfd7zXZ\x00"),  # xz
+    (0, b"\x28\xb5\x2f\xfd"),  # zstd
+    (0, b"7z\xbc\xaf\x27\x1c"),  # 7z
+    (0, b"Rar!\x1a\x07"),  # rar
+    (0, b"\xff\xd8\xff"),  # jpeg
+    (0, b"\x89PNG\r\n\x1a\n"),  # png
+    (0, b"GIF8"),  # gif
+    (0, b"\x1a\x45\xdf\xa3"),  # matroska, webm
+    (4, b"ftyp"),  # mp4, mov, m4a
+    (0, b"OggS"),  # ogg
+    (0, b"fLaC"),  # flac
+    (0, b"ID3"),  # mp3
+    (0x8001, b"CD001"),  # iso9660
+)
+PROBE_SAMPLE_SIZE = 64 * 1024
+
+
+def is_compressible(filePath, minRatio):
+    """Decides whether a file is worth compressing from its magic bytes and by
+    trial compressing a sample from its start and middle. minRatio is the
+    fraction of the sample that compression has to save"""
+    with open(filePath, "rb") as probedFile:
+        header = probedFile.read(max(PROBE_SAMPLE_SIZE, 0x8001 + 5))
+        for offset, signature in INCOMPRESSIBLE_SIGNATURES:
+            if header[offset : offset + len(signature)] == signature:
+                return False
+
+        sample = header[:PROBE_SAMPLE_SIZE]
+        fileSize = os.fstat(probedFile.fileno()).st_size
+        if fileSize > 2 * PROBE_SAMPLE_SIZE:
+            probedFile.seek(fileSize // 2)
+            sample += probedFile.read(PROBE_SAMPLE_SIZE)
+
+    if not sample:
+        return True
+    return 1 - len(zlib.compress(sample, 1)) / len(sample) >= minRatio
+
+
+def compress_path(filePath, codecName, level=None, minRatio=None):
+    """Compresses a file or directory next to itself. The output is written to
+    a temporary file that is renamed into place once it is complete, so a
+    partial archive is never left under the final name, and an existing file
+    under that name is never replaced. The archive gets the owner and
+    permissions of the source, without execute bits. If minRatio is given,
+    files that fail the compressibility probe are left as they are.
+
+    Return:
+    (filePath, compressedPath, members) as CompressionCodec.write returns
+    them, compressedPath and members are None if it was left as is
+    """
+    if (
+        minRatio is not None
+        and not os.path.isdir(filePath)
+        and not is_compressible(filePath, minRatio)
+    ):
+        return filePath, None, None
+
+    import tempfile
+
+    sourceDetails = os.stat(filePath)
+    codec = CompressionCodec(codecName, level)
+    compressedPath = codec.compressed_path(filePath)
+    if os.path.lexists(compressedPath):
+        raise_file_exists(compressedPath)
+    fd, temporaryPath = tempfile.mkstemp(
+        prefix=PARTIAL_ARCHIVE_PREFIX,
+        suffix=".tmp",
+        dir=os.path.dirname(compressedPath),
+    )
+    try:
+        with os.fdopen(fd, "wb") as temporaryFile:
+            members = codec.write(temporaryFile, filePath)
+            temporaryFile.flush()
+            os.fchmod(
+                temporaryFile.fileno(), stat.S_IMODE(sourceDetails.st_mode) & ~0o111
+            )
+            os.fsync(temporaryFile.fileno())
+        preserve_ownership(sourceDetails, temporaryPath)
+        rename_without_replacing(temporaryPath, compressedPath)
+    except BaseException:
+        if os.path.lexists(temporaryPath):
+            os.unlink(temporaryPath)
+        raise
+
+    return filePath, compressedPath, members
+
+
+PARTIAL_ARCHIVE_PREFIX = ".download-sweeper-compressing."
+
+
+def raise_file_exists(path):
+    """ Raises the FileExistsError of a refusal to replace path """
+    raise FileExistsError(errno.EEXIST, "Not replacing existing file", path)
+
+
+def rename_without_replacing(sourcePath, destinationPath):
+    """Renames a file to destinationPath, failing with FileExistsError instead
+    of replacing anything already there. Where the filesystem has no
+    hardlinks, an entry created by someone else at the same moment can still
+    be replaced"""
+    try:
+        os.link(sourcePath, destinationPath)
+    except FileExistsError:
+        raise_file_exists(destinationPath)
+    except OSError:
+        if os.path.lexists(destinationPath):
+            raise_file_exists(destinationPath)
+        os.rename(sourcePath, destinationPath)
+        return
+    os.unlink(sourcePath)
+
+
+def remove_path(path):
+    """Removes a file or a directory tree. Under an operations budget, every
+    unlink and rmdir waits for its turn"""
+    if not os.path.isdir(path) or os.path.islink(path):
+        THROTTLE.use_operation()
+        os.remove(path)
+    elif not THROTTLE.limits_operations():
+        import shutil
+
+        shutil.rmtree(path)
+    else:
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files:
+                THROTTLE.use_operation()
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                THROTTLE.use_operation()
+                childPath = os.path.join(root, name)
+                if os.path.islink(childPath):
+                    os.remove(childPath)
+                else:
+                    os.rmdir(childPath)
+        THROTTLE.use_operation()
+        os.rmdir(path)
+
+
+TOMBSTONE_PREFIX = ".download-sweeper-deleting."
+
+
+def is_transient_entry(path):
+    """Whether path is a tombstone, renamed aside to be deleted, or an archive
+    or a copy still being written, which scans ignore. The next sweep finishes
+    deleting tombstones an interrupted one left behind"""
+    return os.path.basename(path.rstrip(os.sep)).startswith(
+        (TOMBSTONE_PREFIX, PARTIAL_ARCHIVE_PREFIX, PARTIAL_COPY_PREFIX)
+    )
+
+
+class DeletionNode(object):
+    """ A directory being emptied by TreeDeleter """
+
+    __slots__ = ("parent", "name", "fd", "pending")
+
+    def __init__(self, parent, name):
+        self.parent = parent
+        self.name = name
+        self.fd = None
+        self.pending = 0
+
+
+class TreeDeleter(object):
+    """Deletes entries of the purge tier. An entry is first renamed to a
+    tombstone next to it, so an interrupted deletion is finished by the next
+    sweep, and then removed through directory file descriptors: each
+    directory is opened relative to its parent and emptied with scandir and
+    unlink relative to its own descriptor, so no path is resolved twice.
+    Directories are emptied depth first by up to workers threads, each
+    removed as soon as its last child is. Errors are counted and skipped.
+    Deleted bytes are the sizes of the files unlinked, and reclaimed bytes are
+    the blocks of files whose last link was removed"""
+
+    MAX_REPORTED_ERRORS = 5
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.lock = threading.Condition()
+
+    @classmethod
+    def from_config(cls, configurationManager):
+        return cls(configurationManager.get_option_value("deletion_workers"))
+
+    def delete(self, path):
+        """Renames path to a tombstone and deletes it. Tombstone names have a
+        fixed length, so that any name can be renamed to one.
+
+        Return:
+        (deletedBytes, reclaimedBytes, errorCount), OSError is raised if it
+        cannot be renamed
+        """
+        path = path.rstrip(os.sep)
+        tombstonePath = os.path.join(
+            os.path.dirname(path),
+            "{}{:x}.{:x}".format(TOMBSTONE_PREFIX, time.time_ns(), os.getpid()),
+        )
+        THROTTLE.use_operation()
+        os.rename(path, tombstonePath)
+        return self.delete_tombstone(tombstonePath)
+
+    def delete_tombstone(self, tombstonePath):
+        """ Deletes a tombstone, returning what delete returns """
+        self.tombstonePath = tombstonePath
+        self.deletedBytes, self.reclaimedBytes, self.errorCount = 0, 0, 0
+        self.stack, self.finished = [], False
+
+        parentFd = os.open(os.path.dirname(tombstonePath), os.O_RDONLY)
+        try:
+            name = os.path.basename(tombstonePath)
+            fileDetails = os.lstat(name, dir_fd=parentFd)
+            if not stat.S_ISDIR(fileDetails.st_mode):
+                self.unlink(parentFd, name, fileDetails)
+                return self.deletedBytes, self.reclaimedBytes, self.errorCount
+
+            parent = DeletionNode(None, os.path.dirname(tombstonePath))
+            parent.fd = parentFd
+            self.root = DeletionNode(parent, name)
+            self.stack.append(self.root)
+            threads = [
+                threading.Thread(target=self.work)
+                for worker in range(self.workers - 1)
+            ]
+            for thread in threads:
+                thread.start()
+            self.work()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.close(parentFd)
+        return self.deletedBytes, self.reclaimedBytes, self.errorCount
+
+    def report_error(self, name, exception):
+        with self.lock:
+            self.errorCount += 1
+            if self.errorCount <= self.MAX_REPORTED_ERRORS:
+                print(
+                    "Error deleting {0} in {1}: {2}".format(
+                        name, self.tombstonePath, exception
+                    )
+                )
+
+    def unlink(self, directoryFd, name, fileDetails=None):
+        try:
+            if fileDetails is None:
+                fileDetails = os.lstat(name, dir_fd=directoryFd)
+            THROTTLE.use_operation()
+            os.unlink(name, dir_fd=directoryFd)
+        except OSError as exception:
+            self.report_error(name, exception)
+            return
+        with self.lock:
+            self.deletedBytes += fileDetails.st_size
+            if fileDetails.st_nlink <= 1:
+                self.reclaimedBytes += fileDetails.st_blocks * 512
+
+    def empty_directory(self, node):
+        """Opens a directory, unlinks everything in it but subdirectories and
+        returns those"""
+        children = []
+        try:
+            node.fd = os.open(
+                node.name,
+                os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                dir_fd=node.parent.fd,
+            )
+            with os.scandir(node.fd) as dirEntries:
+                for dirEntry in dirEntries:
+                    if dirEntry.is_dir(follow_symlinks=False):
+                        children.append(DeletionNode(node, dirEntry.name))
+                    else:
+                        self.unlink(node.fd, dirEntry.name)
+        except OSError as exception:
+            self.report_error(node.name, exception)
+        return children
+
+    def remove_directory(self, node):
+        """Removes an emptied directory, and every ancestor that it was the
+        last remaining child of"""
+        while node is not None:
+            if node.fd is not None:
+                os.close(node.fd)
+                node.fd = None
+            try:
+                THROTTLE.use_operation()
+                os.rmdir(node.name, dir_fd=node.parent.fd)
+            except OSError as exception:
+                self.report_error(node.name, exception)
+
+            with self.lock:
+                if node is self.root:
+                    self.finished = True
+                    self.lock.notify_all()
+                    return
+                node = node.parent
+                node.pending -= 1
+                if node.pending:
+                    return
+
+    def work(self):
+        while True:
+            with self.lock:
+                while not self.stack and not self.finished:
+                    self.lock.wait()
+                if self.finished:
+                    return
+                node = self.stack.pop()
+
+            children = self.empty_directory(node)
+            with self.lock:
+                node.pending = len(children)
+                if children:
+                    self.stack.extend(children)
+                    self.lock.notify_all()
+                    continue
+            self.remove_directory(node)
+
+
+def resume_deletions(configurationManager):
+    """ Finishes deleting the tombstones an interrupted sweep left behind """
+    deleter = TreeDeleter.from_config(configurationManager)
+    for directoryPath in configurationManager.get_option_value("purge_directories"):
+        try:
+            names = os.listdir(directoryPath)
+        except OSError:
+            continue
+        for name in names:
+            if not name.startswith(TOMBSTONE_PREFIX):
+                continue
+            try:
+                deletedBytes, reclaimedBytes, errorCount = deleter.delete_tombstone(
+                    os.path.join(directoryPath, name)
+                )
+            except OSError as exception:
+                METRICS.count("errors")
+                print("Error deleting {0}: {1}".format(name, exception))
+                continue
+            METRICS.count("bytes_reclaimed", reclaimedBytes)
+            METRICS.count("errors", errorCount)
+
+
+def compression_worker_count(configurationManager, jobCount):
+    workers = configurationManager.get_option_value("compression_workers")
+    if not workers:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, jobCount))
+
+
+def run_compression_jobs(configurationManager, filePaths):
+    """Compresses every path, on a process pool when more than one worker is
+    available, and yields what compress_path returns as each one finishes.
+    Paths that fail to compress are reported and skipped"""
+    codecName = configurationManager.get_option_value("compression_codec")
+    level = configurationManager.get_option_value("compression_level")
+    minRatio = configurationManager.get_option_value("compression_min_ratio")
+    CompressionCodec(codecName, level)  # Fail early on a bad configuration
+
+    workers = compression_worker_count(configurationManager, len(filePaths))
+    if workers == 1:
+        for filePath in filePaths:
+            try:
+                yield compress_path(filePath, codecName, level, minRatio)
+            except Exception as exception:
+                METRICS.count("errors")
+                print("Error compressing {0}: {1}".format(filePath, exception))
+                continue
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=configure_worker_throttle,
+        initargs=(THROTTLE.shared_settings(workers),),
+    ) as executor:
+        futures = {
+            executor.submit(
+                compress_path, filePath, codecName, level, minRatio
+            ): filePath
+            for filePath in filePaths
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as exception:
+                METRICS.count("errors")
+                print(
+                    "Error compressing {0}: {1}".format(futures[future], exception)
+                )
+                continue
+
+
+def compress_archive_files(configurationManager, recordKeeper, candidatePaths=None):
+    """Compresses the given archived paths, or every uncompressed archive if
+    none are given"""
+    if candidatePaths is None:
+        candidatePaths = recordKeeper.get_filepaths_in_type(
+            ConfigKeyTranslator.ARCHIVES
+        )
+
+    filePaths, probedIdentities, originalSizes = [], {}, {}
+    directoryPaths = set()
+    sharedPaths = {}  # First path of an inode: [other paths of that inode]
+    pathsByInode = {}
+    for filePath in candidatePaths:
+        if is_compressed_extension(os.path.splitext(filePath)[1]):
+            continue
+
+        METRICS.count("stat_calls")
+        try:
+            fileDetails = os.stat(filePath)
+        except OSError:
+            continue
+
+        identity = (fileDetails.st_ino, fileDetails.st_mtime_ns)
+        if recordKeeper.get_compressibility(filePath, *identity) is False:
+            continue
+        probedIdentities[filePath] = identity
+
+        # Hardlinked files, such as deduplicated archives, are compressed once
+        inode = (fileDetails.st_dev, fileDetails.st_ino)
+        if not stat.S_ISDIR(fileDetails.st_mode) and inode in pathsByInode:
+            sharedPaths[pathsByInode[inode]].append(filePath)
+            continue
+        pathsByInode[inode] = filePath
+        sharedPaths[filePath] = []
+        if stat.S_ISDIR(fileDetails.st_mode):
+            directoryPaths.add(filePath)
+        originalSizes[filePath] = (
+            summarize_tree(filePath)[1]
+            if stat.S_ISDIR(fileDetails.st_mode)
+            else fileDetails.st_size
+        )
+        filePaths.append(filePath)
+
+    if not filePaths:
+        return
+
+    codec = CompressionCodec(
+        configurationManager.get_option_value("compression_codec"),
+        configurationManager.get_option_value("compression_level"),
+    )
+    for filePath, compressedPath, members in run_compression_jobs(
+        configurationManager, filePaths
+    ):
+        if compressedPath is None:
+            for sharedPath in [filePath] + sharedPaths[filePath]:
+                recordKeeper.set_compressibility(
+                    sharedPath, *probedIdentities[sharedPath], compressible=False
+                )
+            continue
+
+        isTarball = codec.holds_tarball(filePath in directoryPaths)
+        try:
+            compressedSize = os.stat(compressedPath).st_size
+            METRICS.count("bytes_compressed", originalSizes[filePath])
+            METRICS.count("bytes_saved", originalSizes[filePath] - compressedSize)
+            operationId = JOURNAL.intend(
+                SweepPlan.COMPRESS,
+                filePath,
+                [compressedPath],
+                members=members,
+                tarball=isTarball,
+            )
+            # Once the original is gone only the journal knows its members
+            JOURNAL.sync()
+            replace_compressed_record(recordKeeper, filePath, compressedPath)
+            ARCHIVE_INDEX.replace_with_archive(
+                filePath, compressedPath, members, isTarball
+            )
+            JOURNAL.finish(operationId)
+        except Exception as exception:
+            METRICS.count("errors")
+            print(
+                "Error replacing {0} with {1}: {2}".format(
+                    filePath, compressedPath, exception
+                )
+            )
+            continue
+
+        for sharedPath in sharedPaths[filePath]:
+            try:
+                sharedCompressedPath = codec.compressed_path(sharedPath)
+                if os.path.lexists(sharedCompressedPath):
+                    raise_file_exists(sharedCompressedPath)
+                operationId = JOURNAL.intend(
+                    SweepPlan.COMPRESS,
+                    sharedPath,
+                    [sharedCompressedPath],
+                    members=members,
+                    tarball=isTarball,
+                )
+                JOURNAL.sync()
+                try:
+                    os.link(compressedPath, sharedCompressedPath)
+                except OSError:
+                    # Nothing was replaced, so there is nothing to finish
+                    JOURNAL.finish(operationId)
+                    raise
+                replace_compressed_record(
+                    recordKeeper, sharedPath, sharedCompressedPath
+                )
+                ARCHIVE_INDEX.replace_with_archive(
+                    sharedPath, sharedCompressedPath, members, isTarball
+                )
+                JOURNAL.finish(operationId)
+            except Exception as exception:
+                METRICS.count("errors")
+                print(
+                    "Error replacing {0} with a link to {1}: {2}".format(
+                        sharedPath, compressedPath, exception
+                    )
+                )
+                continue
+
+
+def replace_compressed_record(recordKeeper, filePath, compressedPath):
+    """ Removes a compressed archive and moves its record to the output """
+    remove_path(filePath)
+    recordedDatetime = recordKeeper.get_record(ConfigKeyTranslator.ARCHIVES, filePath)
+    recordKeeper.delete_record(filePath, ConfigKeyTranslator.ARCHIVES)
+    recordKeeper.add_record(
+        compressedPath, ConfigKeyTranslator.ARCHIVES, recordedDatetime
+    )
+
+
+def write_restored_file(sourceFile, restoredPath, mode=None, modifiedTime=None):
+    """Writes a restored file out of a file object, without ever replacing an
+    existing file"""
+    import shutil
+
+    assert_dir_exists(os.path.dirname(restoredPath))
+    with open(restoredPath, "xb") as restoredFile:
+        shutil.copyfileobj(sourceFile, restoredFile, 1024 * 1024)
+    if mode:
+        os.chmod(restoredPath, stat.S_IMODE(mode))
+    if modifiedTime is not None:
+        os.utime(restoredPath, (time.time(), modifiedTime))
+
+
+def write_restored_link(linkTarget, restoredPath):
+    """ Creates a restored symlink, without ever replacing an existing file """
+    assert_dir_exists(os.path.dirname(restoredPath))
+    os.symlink(linkTarget, restoredPath)
+
+
+def make_restored_directory(restoredPath):
+    """Creates a restored directory, or keeps the directory already there.
+    Returns whether it was created"""
+    assert_dir_exists(os.path.dirname(restoredPath))
+    try:
+        os.mkdir(restoredPath)
+    except FileExistsError:
+        if os.path.islink(restoredPath) or not os.path.isdir(restoredPath):
+            raise
+        return False
+    return True
+
+
+def restore_archived(archivePath, restoredPaths, isTarball=None):
+    """Restores members of an archive, given as {member: restoredPath}, which
+    may be files, directories or symlinks. Only those members are read out of
+    zip archives, and tarballs are read up to the last of them. Whether the
+    archive holds a tarball is guessed from its name if isTarball is None.
+    The empty member stands for an entry archived as it is, which is copied.
+
+    Return:
+    The number of members that could not be restored
+    """
+    if "" in restoredPaths:
+        restoredPath = restoredPaths[""]
+        if os.path.lexists(restoredPath):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), restoredPath)
+        assert_dir_exists(os.path.dirname(restoredPath))
+        copy_into_place(archivePath, [restoredPath])
+        return 0
+
+    codecName, guessedTarball = CompressionCodec.of_archive(archivePath)
+    if codecName is None:
+        raise ValueError("{} is not a compressed archive".format(archivePath))
+    if isTarball is None:
+        isTarball = guessedTarball
+
+    failures = 0
+    remainingPaths = dict(restoredPaths)
+    createdDirectories = []  # (restoredPath, mode, modifiedTime)
+    if codecName == CompressionCodec.ZIP:
+        from zipfile import ZipFile
+
+        with ZipFile(archivePath) as zipFile:
+            for member, restoredPath in restoredPaths.items():
+                remainingPaths.pop(member)
+                zipInfo = zipFile.getinfo(member)
+                mode = zipInfo.external_attr >> 16
+                modifiedTime = time.mktime(zipInfo.date_time + (0, 0, -1))
+                try:
+                    if zipInfo.is_dir():
+                        if make_restored_directory(restoredPath):
+                            createdDirectories.append(
+                                (restoredPath, mode, modifiedTime)
+                            )
+                    elif stat.S_ISLNK(mode):
+                        write_restored_link(
+                            zipFile.read(zipInfo).decode("utf-8"), restoredPath
+                        )
+                    else:
+                        with zipFile.open(zipInfo) as memberFile:
+                            write_restored_file(
+                                memberFile, restoredPath, mode, modifiedTime
+                            )
+                except OSError as exception:
+                    failures += 1
+                    print("Error restoring {0}: {1}".format(restoredPath, exception))
+    else:
+        import tarfile
+
+        with open(archivePath, "rb") as rawFile:
+            with CompressionCodec(codecName).open_reader(rawFile) as stream:
+                if not isTarball:
+                    (restoredPath,) = remainingPaths.values()
+                    write_restored_file(stream, restoredPath)
+                    return 0
+
+                with tarfile.open(fileobj=stream, mode="r|") as tarFile:
+                    for tarInfo in tarFile:
+                        restoredPath = remainingPaths.pop(tarInfo.name, None)
+                        if restoredPath is None:
+                            continue
+                        try:
+                            if tarInfo.isdir():
+                                if make_restored_directory(restoredPath):
+                                    createdDirectories.append(
+                                        (restoredPath, tarInfo.mode, tarInfo.mtime)
+                                    )
+                            elif tarInfo.issym():
+                                write_restored_link(tarInfo.linkname, restoredPath)
+                            elif tarInfo.isreg():
+                                write_restored_file(
+                                    tarFile.extractfile(tarInfo),
+                                    restoredPath,
+                                    tarInfo.mode,
+                                    tarInfo.mtime,
+                                )
+                            else:
+                                raise IOError(
+                                    errno.EINVAL,
+                                    "Cannot restore special file {}".format(
+                                        tarInfo.name
+                                    ),
+                                )
+                        except OSError as exception:
+                            failures += 1
+                            print(
+                                "Error restoring {0}: {1}".format(
+                                    restoredPath, exception
+                                )
+                            )
+                        if not remainingPaths:
+                            break
+
+    for member, restoredPath in remainingPaths.items():
+        failures += 1
+        print(
+            "Error restoring {0}: {1} is not in {2}".format(
+                restoredPath, member, archivePath
+            )
+        )
+
+    # Directory times are restored last, after their contents stopped changing
+    for restoredPath, mode, modifiedTime in reversed(createdDirectories):
+        try:
+            if mode:
+                os.chmod(restoredPath, stat.S_IMODE(mode))
+            os.utime(restoredPath, (time.time(), modifiedTime))
+        except OSError as exception:
+            failures += 1
+            print("Error restoring {0}: {1}".format(restoredPath, exception))
+    return failures
+
+
+DEDUP_PARTIAL_SIZE = 64 * 1024
+
+
+def hash_file(filePath, partial=False):
+    """Returns the BLAKE2b digest of a file's contents, or only of its first
+    and last DEDUP_PARTIAL_SIZE bytes if partial is set"""
+    import hashlib
+
+    digest = hashlib.blake2b()
+    with open(filePath, "rb") as openFile:
+        if not partial:
+            for chunk in iter(lambda: openFile.read(TRANSFER_CHUNK_SIZE), b""):
+                THROTTLE.use_bytes(len(chunk))
+                digest.update(chunk)
+            return digest.digest()
+
+        digest.update(openFile.read(DEDUP_PARTIAL_SIZE))
+        if os.fstat(openFile.fileno()).st_size > 2 * DEDUP_PARTIAL_SIZE:
+            openFile.seek(-DEDUP_PARTIAL_SIZE, os.SEEK_END)
+            digest.update(openFile.read(DEDUP_PARTIAL_SIZE))
+    return digest.digest()
+
+
+def group_paths_by(filePaths, key):
+    """ Groups paths by key(path), dropping groups of one and unreadable paths """
+    groups = {}
+    for filePath in filePaths:
+        try:
+            groups.setdefault(key(filePath), []).append(filePath)
+        except OSError:
+            continue
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicate_files(filePaths):
+    """Finds regular files with identical contents on the same device. Files
+    are grouped by size first, then by a partial hash and only then by a full
+    hash, so most files are never read. Paths that already share an inode are
+    treated as one file.
+
+    Return:
+    ([[filePath]], {filePath: lstat result}) with one path per inode in each
+    group
+    """
+    fileDetailsByPath, seenInodes, sizeGroups = {}, set(), {}
+    for filePath in filePaths:
+        METRICS.count("stat_calls")
+        try:
+            fileDetails = os.lstat(filePath)
+        except OSError:
+            continue
+        if not stat.S_ISREG(fileDetails.st_mode) or not fileDetails.st_size:
+            continue
+
+        inode = (fileDetails.st_dev, fileDetails.st_ino)
+        if inode in seenInodes:
+            continue
+        seenInodes.add(inode)
+        fileDetailsByPath[filePath] = fileDetails
+        sizeGroups.setdefault((fileDetails.st_dev, fileDetails.st_size), []).append(
+            filePath
+        )
+
+    duplicateGroups = []
+    for sizeGroup in sizeGroups.values():
+        if len(sizeGroup) < 2:
+            continue
+        for partialGroup in group_paths_by(
+            sizeGroup, lambda filePath: hash_file(filePath, partial=True)
+        ):
+            duplicateGroups.extend(group_paths_by(partialGroup, hash_file))
+
+    return duplicateGroups, fileDetailsByPath
+
+
+def replace_with_hardlink(targetPath, linkPath):
+    """Atomically replaces linkPath with a hardlink to targetPath, so linkPath
+    always holds either its old contents or the new link"""
+    temporaryPath = os.path.join(
+        os.path.dirname(linkPath),
+        ".{}.{}.link".format(os.path.basename(linkPath), os.getpid()),
+    )
+    os.link(targetPath, temporaryPath)
+    try:
+        os.replace(temporaryPath, linkPath)
+    except BaseException:
+        os.unlink(temporaryPath)
+        raise
+
+
+def deduplicate_archive_files(recordKeeper):
+    """Replaces every uncompressed archived file whose contents match another
+    one on the same device with a hardlink to it, so the contents are stored,
+    and later compressed, only once"""
+    candidatePaths = [
+        filePath
+        for filePath in recordKeeper.get_filepaths_in_type(ConfigKeyTranslator.ARCHIVES)
+        if not is_compressed_extension(os.path.splitext(filePath)[1])
+    ]
+    duplicateGroups, fileDetailsByPath = find_duplicate_files(candidatePaths)
+    for duplicateGroup in duplicateGroups:
+        keptPath = min(duplicateGroup)
+        for duplicatePath in duplicateGroup:
+            if duplicatePath == keptPath:
+                continue
+
+            plannedDetails = fileDetailsByPath[duplicatePath]
+            try:
+                fileDetails = os.lstat(duplicatePath)
+                if (fileDetails.st_ino, fileDetails.st_mtime_ns) != (
+                    plannedDetails.st_ino,
+                    plannedDetails.st_mtime_ns,
+                ):
+                    continue  # Changed since it was hashed
+                replace_with_hardlink(keptPath, duplicatePath)
+            except OSError as exception:
+                METRICS.count("errors")
+                print("Error deduplicating {0}: {1}".format(duplicatePath, exception))
+                continue
+
+            METRICS.count("bytes_deduplicated", fileDetails.st_size)
+
+
+def is_complete_copy(path, size):
+    """Whether path holds a whole copy of an entry of the given size, if it is
+    known"""
+    try:
+        fileDetails = os.lstat(path)
+    except OSError:
+        return False
+    if size is None:
+        return True
+    if stat.S_ISDIR(fileDetails.st_mode):
+        return summarize_tree(path)[1] == size
+    return fileDetails.st_size == size
+
+
+def finish_interrupted_move(intent, recordKeeper):
+    """Records a journaled move that was made but not recorded. The move was
+    made if its source is gone and a whole copy of it is in a destination.
+    Copies cut short are discarded, and made again from that one if it was
+    moved to every destination. Returns whether it was"""
+    newFilePaths = [
+        os.path.join(destination, File(intent["source"]).filename)
+        for destination in intent["destinations"]
+    ]
+    for newFilePath in newFilePaths:
+        partialPath = partial_copy_path(newFilePath)
+        if os.path.lexists(partialPath):
+            remove_path(partialPath)
+    if os.path.lexists(intent["source"]):
+        return False  # Never moved, or moved back after a failed copy
+
+    completePaths = [
+        newFilePath
+        for newFilePath in newFilePaths
+        if is_complete_copy(newFilePath, intent["bytes"])
+    ]
+    if not completePaths:
+        return False
+    if not intent["move_to_all"]:
+        newFilePaths = completePaths[:1]
+    elif len(completePaths) < len(newFilePaths):
+        try:
+            copy_into_place(
+                completePaths[0],
+                [
+                    newFilePath
+                    for newFilePath in newFilePaths
+                    if newFilePath not in completePaths
+                ],
+            )
+        except OSError as exception:
+            METRICS.count("errors")
+            print("Error copying {0}: {1}".format(completePaths[0], exception))
+            newFilePaths = completePaths
+
+    configType = (
+        ConfigKeyTranslator.ARCHIVES
+        if intent["action"] == SweepPlan.ARCHIVE
+        else ConfigKeyTranslator.PURGES
+    )
+    record_move(
+        recordKeeper,
+        configType,
+        intent["source"],
+        newFilePaths,
+        intent["bytes"],
+        intent["time"],
+    )
+    return True
+
+
+def finish_interrupted_compression(intent, recordKeeper):
+    """Finishes a journaled compression whose archive was written but whose
+    original may not have been removed, recorded or indexed yet. Returns
+    whether the archive was written"""
+    filePath, compressedPath = intent["source"], intent["destinations"][0]
+    if not os.path.lexists(compressedPath):
+        return False
+
+    if os.path.lexists(filePath):
+        remove_path(filePath)
+    if recordKeeper.record_exists(ConfigKeyTranslator.ARCHIVES, filePath):
+        moveDate = recordKeeper.get_record(ConfigKeyTranslator.ARCHIVES, filePath)
+        recordKeeper.delete_record(filePath, ConfigKeyTranslator.ARCHIVES)
+        recordKeeper.add_record(compressedPath, ConfigKeyTranslator.ARCHIVES, moveDate)
+    elif not recordKeeper.record_exists(ConfigKeyTranslator.ARCHIVES, compressedPath):
+        recordKeeper.add_record(
+            compressedPath, ConfigKeyTranslator.ARCHIVES, intent["time"]
+        )
+    if not ARCHIVE_INDEX.is_indexed(compressedPath):
+        ARCHIVE_INDEX.replace_with_archive(
+            filePath, compressedPath, intent["members"], intent.get("tarball")
+        )
+    return True
+
+
+def replay_journal(entries, recordKeeper):
+    """Applies the record changes journaled by an interrupted run, and
+    finishes the operations it started but did not journal as done, instead
+    of leaving the next scan to record their results as new. Returns whether
+    there was anything to replay"""
+    if not entries:
+        return False
+
+    unfinishedIntents = {}
+    for entry in entries:
+        if "record" in entry:
+            if entry["record"] == "add":
+                recordKeeper.add_record(entry["path"], entry["tier"], entry["value"])
+            elif entry["record"] == "delete":
+                if recordKeeper.record_exists(entry["tier"], entry["path"]):
+                    recordKeeper.delete_record(entry["path"], entry["tier"])
+            else:
+                recordKeeper.set_compressibility(entry["path"], *entry["value"])
+        elif "intent" in entry:
+            unfinishedIntents[entry["intent"]] = entry
+        elif "done" in entry:
+            unfinishedIntents.pop(entry["done"], None)
+
+    for intent in unfinishedIntents.values():
+        try:
+            if intent["action"] == SweepPlan.COMPRESS:
+                finished = finish_interrupted_compression(intent, recordKeeper)
+            else:
+                finished = finish_interrupted_move(intent, recordKeeper)
+        except Exception as exception:
+            METRICS.count("errors")
+            print(
+                "Error finishing the interrupted {0} of {1}: {2}".format(
+                    intent["action"], intent["source"], exception
+                )
+            )
+            continue
+        if finished:
+            METRICS.count("operations_replayed")
+    return True
+
+
+def checkpoint_records(recordKeeper):
+    """ Writes the records and empties the journal, which they now cover """
+    recordKeeper.write_records()
+    JOURNAL.truncate()
+
+
+def reconcile_records(sweeper, records):
+    """Lists the archive and purge tiers once and makes the records, and the
+    archive index, match what is in them: records of paths that are gone are
+    dropped and untracked entries are recorded as moved now. Nothing but the
+    directory listings touches the disk"""
+    tierPaths, unlistedDirectories = {}, set()
+    for configType in (ConfigKeyTranslator.ARCHIVES, ConfigKeyTranslator.PURGES):
+        tierPaths[configType] = set(
+            file.path
+            for file in sweeper.iter_tier(
+                ConfigKeyTranslator(configType), False, unlistedDirectories
+            )
+        )
+
+    records.reconcile_records(tierPaths, unlistedDirectories)
+    ARCHIVE_INDEX.reconcile(
+        tierPaths[ConfigKeyTranslator.ARCHIVES] | tierPaths[ConfigKeyTranslator.PURGES],
+        unlistedDirectories,
+    )
+
+
+def free_space(path):
+    """ Returns (freeBytes, totalBytes) of the filesystem holding path """
+    filesystemDetails = os.statvfs(path)
+    return (
+        filesystemDetails.f_bavail * filesystemDetails.f_frsize,
+        filesystemDetails.f_blocks * filesystemDetails.f_frsize,
+    )
+
+
+def disk_usage(path):
+    """ Returns the bytes allocated to a file or directory tree """
+    fileDetails = os.lstat(path)
+    usedBytes = fileDetails.st_blocks * 512
+    if not stat.S_ISDIR(fileDetails.st_mode):
+        return usedBytes
+
+    pendingDirectories = [path]
+    while pendingDirectories:
+        try:
+            childEntries = os.scandir(pendingDirectories.pop())
+        except OSError:
+            continue
+
+        with childEntries:
+            for childEntry in childEntries:
+                try:
+                    if childEntry.is_dir(follow_symlinks=False):
+                        pendingDirectories.append(childEntry.path)
+                    usedBytes += childEntry.stat(follow_symlinks=False).st_blocks * 512
+                except OSError:
+                    continue
+
+    return usedBytes
+
+
+class DiskPressureEvictor(object):
+    """Frees space on filesystems whose free space dropped below the low
+    watermark by moving entries on to their next tier ahead of time, until
+    the high watermark is reached. Purge entries go first, then archives, then
+    downloads; within a tier the least recently used entries go first,
+    weighted by their size"""
+
+    # configType: (rank, option enabling its tier operation)
+    _tier_list = {
+        ConfigKeyTranslator.PURGES: (0, "delete_from_purge"),
+        ConfigKeyTranslator.ARCHIVES: (1, "purge_archives"),
+        ConfigKeyTranslator.DOWNLOADS: (2, "archive_downloads"),
+    }
+
+    def __init__(self, sweeper, configurationManager, recordKeeper):
+        self.sweeper = sweeper
+        self.configurationManager = configurationManager
+        self.recordKeeper = recordKeeper
+
+    def destination_paths(self, configType):
+        """ Returns the directories entries of a tier would be moved into """
+        if configType == ConfigKeyTranslator.DOWNLOADS:
+            pathKey, moveToAllKey = "archive_directories", "move_to_all_archive_dirs"
+        else:
+            pathKey, moveToAllKey = "purge_directories", "move_to_all_purge_dirs"
+
+        paths = self.configurationManager.get_option_value(pathKey)
+        if self.configurationManager.get_option_value(moveToAllKey):
+            return paths
+        return paths[:1]
+
+    def frees_space_on(self, configType, device):
+        """Whether acting on an entry of the tier removes its bytes from the
+        device, instead of renaming it into a directory on the same device"""
+        if configType == ConfigKeyTranslator.PURGES:
+            return True
+
+        destinationDevices = [
+            device_of(path) for path in self.destination_paths(configType)
+        ]
+        return bool(destinationDevices) and device not in destinationDevices
+
+    def pressured_filesystems(self):
+        """ Returns {device: (directoryPath, highWatermarkBytes)} for every
+        filesystem holding a tier directory that is below the low watermark """
+        filesystems = {}
+        for configType in self._tier_list:
+            for directoryPath in self.configurationManager.get_option_value(
+                ConfigKeyTranslator(configType).path_key
+            ):
+                device = device_of(directoryPath)
+                if device is not None:
+                    filesystems.setdefault(device, directoryPath)
+
+        pressuredFilesystems = {}
+        for device, directoryPath in filesystems.items():
+            freeBytes, totalBytes = free_space(directoryPath)
+            lowWatermark = ConfigFileSizeParser.bytes_from_config_str(
+                self.configurationManager.get_option_value(
+                    "free_space_low_watermark"
+                ),
+                totalBytes,
+            )
+            highWatermark = ConfigFileSizeParser.bytes_from_config_str(
+                self.configurationManager.get_option_value(
+                    "free_space_high_watermark"
+                ),
+                totalBytes,
+            )
+            if freeBytes < lowWatermark:
+                pressuredFilesystems[device] = (directoryPath, highWatermark)
+
+        return pressuredFilesystems
+
+    def candidates(self, device):
+        """ Returns a heap of (rank, -weight, path, configType, file) for every
+        entry on the device that can be moved off it """
+        now = time.time()
+        candidateHeap = []
+        for configType, (rank, enabledKey) in self._tier_list.items():
+            if not self.configurationManager.get_option_value(enabledKey):
+                continue
+            if not self.frees_space_on(configType, device):
+                continue
+
+            configTranslator = ConfigKeyTranslator(configType)
+            for file in self.sweeper.scan_tier(
+                configTranslator, configType == ConfigKeyTranslator.DOWNLOADS
+            ):
+                if device_of(os.path.dirname(file.path)) != device:
+                    continue
+
+                if configType == ConfigKeyTranslator.DOWNLOADS:
+                    lastUsedTime = file.lastAccessTime
+                    if lastUsedTime is None:
+                        lastUsedTime = 0
+                else:
+                    try:
+                        lastUsedTime = self.recordKeeper.get_record(
+                            configType, file.path
+                        )
+                    except KeyError:
+                        continue  # Untracked, it will be recorded as of now
+                if lastUsedTime == float("inf"):
+                    continue
+
+                try:
+                    weight = max(now - lastUsedTime, 1) * disk_usage(file.path)
+                except OSError:
+                    continue
+                heapq.heappush(
+                    candidateHeap, (rank, -weight, file.path, configType, file)
+                )
+
+        return candidateHeap
+
+    def evict(self, file, configType):
+        if configType == ConfigKeyTranslator.PURGES:
+            delete_files([file], self.configurationManager, self.recordKeeper)
+        elif configType == ConfigKeyTranslator.ARCHIVES:
+            purge_files([file], self.configurationManager, self.recordKeeper)
+        else:
+            archive_files([file], self.configurationManager, self.recordKeeper)
+
+    def run(self):
+        for device, (directoryPath, highWatermark) in (
+            self.pressured_filesystems().items()
+        ):
+            candidateHeap = self.candidates(device)
+            while candidateHeap and free_space(directoryPath)[0] < highWatermark:
+                rank, weight, path, configType, file = heapq.heappop(candidateHeap)
+                self.evict(file, configType)
+
+
+def evict_for_disk_pressure(sweeper, configurationManager, recordKeeper):
+    if not configurationManager.get_option_value("evict_on_disk_pressure"):
+        return
+    DiskPressureEvictor(sweeper, configurationManager, recordKeeper).run()
+
+
+def run_sweep(sweeper, configurationManager, recordKeeper):
+    """Runs every enabled tier operation over every tier directory once. Each
+    tier is streamed: its entries are planned and acted on while its scan is
+    still running, so memory stays bounded by the scan and sort windows
+    however large the tier is. Tiers run from the last to the first, so space
+    is freed before anything is moved into it. An entry moved into a tier is
+    recorded as of now, so no later stage picks it up in the same sweep"""
+    with METRICS.phase("reconcile"):
+        reconcile_records(sweeper, recordKeeper)
+    with METRICS.phase("resume_deletions"):
+        resume_deletions(configurationManager)
+
+    planner = SweepPlanner(sweeper, configurationManager, recordKeeper)
+    archivedCount = 0
+    for enabledKey, action, configType, planOperations in (
+        (
+            "delete_from_purge",
+            SweepPlan.DELETE,
+            ConfigKeyTranslator.PURGES,
+            lambda files: planner.plan_deletions(files, withSizes=False),
+        ),
+        (
+            "purge_archives",
+            SweepPlan.PURGE,
+            ConfigKeyTranslator.ARCHIVES,
+            planner.plan_purge,
+        ),
+        (
+            "archive_downloads",
+            SweepPlan.ARCHIVE,
+            ConfigKeyTranslator.DOWNLOADS,
+            planner.plan_archive,
+        ),
+    ):
+        if not configurationManager.get_option_value(enabledKey):
+            continue
+        staleFiles = sweeper.get_stale_file_paths(
+            ConfigKeyTranslator(configType), recordKeeper
+        )
+        with METRICS.phase(action):
+            appliedCount = apply_operations(
+                action, planOperations(staleFiles), configurationManager, recordKeeper
+            )
+        if action == SweepPlan.ARCHIVE:
+            archivedCount = appliedCount
+
+    compressOperations = []
+    if configurationManager.get_option_value("compress_archives"):
+        compressOperations = planner.plan_compression([], set())
+    if configurationManager.get_option_value("deduplicate_archives") and (
+        archivedCount or compressOperations
+    ):
+        with METRICS.phase("deduplicate"):
+            deduplicate_archive_files(recordKeeper)
+    if compressOperations:
+        with METRICS.phase(SweepPlan.COMPRESS):
+            apply_operations(
+                SweepPlan.COMPRESS,
+                compressOperations,
+                configurationManager,
+                recordKeeper,
+            )
+
+    with METRICS.phase("evict"):
+        evict_for_disk_pressure(sweeper, configurationManager, recordKeeper)
+
+
+class InotifyWatcher(object):
+    """Reports entries created, moved or deleted in the top level of watched
+    directories, using the Linux inotify API through ctypes"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+
+    WATCH_MASK = (
+        IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+    )
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # wd: directoryPath
+
+    def watch(self, directoryPath):
+        watchDescriptor = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directoryPath), self.WATCH_MASK
+        )
+        if watchDescriptor >= 0:
+            self.watches[watchDescriptor] = directoryPath
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds (forever if None) for events.
+
+        Return:
+        set([(directoryPath, name)]), name is None when the whole directory
+        has to be rescanned
+        """
+        import select
+
+        changes = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changes
+
+        while True:
+            try:
+                eventBuffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changes
+
+            offset = 0
+            while offset < len(eventBuffer):
+                (
+                    watchDescriptor,
+                    mask,
+                    cookie,
+                    nameLength,
+                ) = self.EVENT_HEADER.unpack_from(eventBuffer, offset)
+                offset += self.EVENT_HEADER.size
+                name = eventBuffer[offset : offset + nameLength].rstrip(b"\0")
+                offset += nameLength
+
+                if mask & self.IN_Q_OVERFLOW:
+                    changes.update((path, None) for path in self.watches.values())
+                elif watchDescriptor in self.watches:
+                    changes.add(
+                        (
+                            self.watches[watchDescriptor],
+                            os.fsdecode(name) if name else None,
+                        )
+                    )
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Reports watched directories whose modification time changed, checking
+    them every interval seconds. Used where inotify is unavailable"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.modificationTimes = {}
+
+    def modification_time(self, directoryPath):
+        try:
+            return os.stat(directoryPath).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(self, directoryPath):
+        self.modificationTimes[directoryPath] = self.modification_time(directoryPath)
+
+    def wait(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        changes = set()
+        for directoryPath, modificationTime in self.modificationTimes.items():
+            currentModificationTime = self.modification_time(directoryPath)
+            if currentModificationTime != modificationTime:
+                self.modificationTimes[directoryPath] = currentModificationTime
+                changes.add((directoryPath, None))
+        return changes
+
+    def close(self):
+        pass
+
+
+def create_watcher(configurationManager):
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(
+            configurationManager.get_option_value("daemon_poll_interval")
+        )
+
+
+class SweepDaemon(object):
+    """Keeps download-sweeper running, acting on every entry as soon as it
+    becomes stale instead of rescanning every directory on a timer. Entries
+    are indexed with the time they become stale and kept in a heap; an entry
+    is checked again when that time comes, since it may have been accessed"""
+
+    def __init__(self, sweeper, configurationManager, recordKeeper, watcher):
+        self.sweeper = sweeper
+        self.configurationManager = configurationManager
+        self.recordKeeper = recordKeeper
+        self.watcher = watcher
+        self.index = {}  # path: dueTime
+        self.schedule = []  # heap of (dueTime, path, configType)
+        self.directoryTypes = {}  # directoryPath: configType
+
+    def tier_is_enabled(self, configType):
+        return self.configurationManager.get_option_value(
+            {
+                ConfigKeyTranslator.DOWNLOADS: "archive_downloads",
+                ConfigKeyTranslator.ARCHIVES: "purge_archives",
+                ConfigKeyTranslator.PURGES: "delete_from_purge",
+            }[configType]
+        )
+
+    def due_time(self, file, configTranslator):
+        """ Returns the time at which a file will become stale """
+        staleLimit = (
+            self.configurationManager.get_snapshot()
+            .staleLimits[configTranslator.stale_limit_key]
+            .total_seconds()
+        )
+        if configTranslator.configType == ConfigKeyTranslator.DOWNLOADS:
+            if file.lastAccessTime is None:
+                return time.time()
+            return file.lastAccessTime + staleLimit
+
+        if not self.recordKeeper.record_exists(configTranslator.configType, file.path):
+            self.recordKeeper.add_record(
+                file.path, configTranslator.configType, int(time.time())
+            )
+        return (
+            self.recordKeeper.get_record(configTranslator.configType, file.path)
+            + staleLimit
+        )
+
+    def index_file(self, file, configTranslator):
+        dueTime = self.due_time(file, configTranslator)
+        self.index[file.path] = dueTime
+        if dueTime != float("inf"):
+            heapq.heappush(
+                self.schedule, (dueTime, file.path, configTranslator.configType)
+            )
+
+    def index_tier(self, configType):
+        configTranslator = ConfigKeyTranslator(configType)
+        for directoryPath in self.configurationManager.get_option_value(
+            configTranslator.path_key
+        ):
+            self.directoryTypes[directoryPath] = configType
+            self.watcher.watch(directoryPath)
+
+        if not self.tier_is_enabled(configType):
+            return
+        for file in self.sweeper.scan_tier(
+            configTranslator, configType == ConfigKeyTranslator.DOWNLOADS
+        ):
+            self.index_file(file, configTranslator)
+
+    def rebuild_index(self):
+        """ Sweeps every directory and indexes whatever is left behind """
+        run_sweep(self.sweeper, self.configurationManager, self.recordKeeper)
+        checkpoint_records(self.recordKeeper)
+        self.index, self.schedule, self.directoryTypes = {}, [], {}
+        for configType in (
+            ConfigKeyTranslator.DOWNLOADS,
+            ConfigKeyTranslator.ARCHIVES,
+            ConfigKeyTranslator.PURGES,
+        ):
+            self.index_tier(configType)
+
+    def refresh_entry(self, directoryPath, name):
+        """ Updates the index after an entry of a watched directory changed """
+        configTranslator = ConfigKeyTranslator(self.directoryTypes[directoryPath])
+        path = os.path.join(directoryPath, name)
+        file = self.sweeper.scan_path(
+            path, configTranslator.configType == ConfigKeyTranslator.DOWNLOADS
+        )
+        if file is None:
+            self.index.pop(path, None)
+            if configTranslator.configType != ConfigKeyTranslator.DOWNLOADS:
+                if self.recordKeeper.record_exists(configTranslator.configType, path):
+                    self.recordKeeper.delete_record(path, configTranslator.configType)
+        elif self.tier_is_enabled(configTranslator.configType):
+            self.index_file(file, configTranslator)
+
+    def refresh_directory(self, directoryPath):
+        try:
+            names = set(os.listdir(directoryPath))
+        except OSError:
+            names = set()
+
+        for path in list(self.index):
+            if os.path.dirname(path) == directoryPath.rstrip(os.sep) and (
+                os.path.basename(path) not in names
+            ):
+                names.add(os.path.basename(path))
+
+        for name in names:
+            self.refresh_entry(directoryPath, name)
+
+    def pop_due_files(self):
+        """ Returns the indexed entries that are stale now, by tier """
+        dueFiles = {}
+        now = time.time()
+        while self.schedule and self.schedule[0][0] <= now:
+            dueTime, path, configType = heapq.heappop(self.schedule)
+            if self.index.get(path) != dueTime:
+                continue  # Superseded by a later entry or no longer indexed
+
+            configTranslator = ConfigKeyTranslator(configType)
+            file = self.sweeper.scan_path(
+                path, configType == ConfigKeyTranslator.DOWNLOADS
+            )
+            if file is None:
+                self.index.pop(path, None)
+                continue
+
+            if self.sweeper.file_is_stale(
+                file,
+                configTranslator,
+                self.recordKeeper,
+                self.sweeper.get_stale_cutoff(configTranslator),
+            ):
+                del self.index[path]
+                dueFiles.setdefault(configType, []).append(file)
+            else:
+                self.index_file(file, configTranslator)
+
+        return dueFiles
+
+    def act_on_due_files(self):
+        dueFiles = self.pop_due_files()
+        if not dueFiles:
+            return
+
+        archive_files(
+            dueFiles.get(ConfigKeyTranslator.DOWNLOADS, []),
+            self.configurationManager,
+            self.recordKeeper,
+        )
+        if dueFiles.get(ConfigKeyTranslator.DOWNLOADS) and (
+            self.configurationManager.get_option_value("compress_archives")
+        ):
+            compress_archive_files(self.configurationManager, self.recordKeeper)
+        purge_files(
+            dueFiles.get(ConfigKeyTranslator.ARCHIVES, []),
+            self.configurationManager,
+            self.recordKeeper,
+        )
+        delete_files(
+            dueFiles.get(ConfigKeyTranslator.PURGES, []),
+            self.configurationManager,
+            self.recordKeeper,
+        )
+        checkpoint_records(self.recordKeeper)
+
+    def run(self):
+        rescanInterval = self.configurationManager.get_option_value(
+            "daemon_rescan_interval"
+        )
+        with METRICS.phase("scan"):
+            self.rebuild_index()
+        nextRescan = time.time() + rescanInterval
+        try:
+            while True:
+                now = time.time()
+                if self.configurationManager.refresh():
+                    THROTTLE.configure(self.configurationManager)
+                    nextRescan = now  # Directories or limits may have changed
+                if now >= nextRescan:
+                    with METRICS.phase("scan"):
+                        self.rebuild_index()
+                    nextRescan = now + rescanInterval
+
+                timeout = nextRescan - now
+                if self.schedule:
+                    timeout = min(timeout, max(0, self.schedule[0][0] - now))
+                # Wake up regularly to check free space and the config file
+                timeout = min(
+                    timeout,
+                    self.configurationManager.get_option_value("daemon_poll_interval"),
+                )
+
+                changes = self.watcher.wait(timeout)
+                for directoryPath, name in changes:
+                    if directoryPath not in self.directoryTypes:
+                        continue  # No longer configured
+                    if name is None:
+                        self.refresh_directory(directoryPath)
+                    else:
+                        self.refresh_entry(directoryPath, name)
+
+                self.act_on_due_files()
+                with METRICS.phase("evict"):
+                    evict_for_disk_pressure(
+                        self.sweeper, self.configurationManager, self.recordKeeper
+                    )
+                if changes:
+                    checkpoint_records(self.recordKeeper)
+                METRICS.export(self.configurationManager)
+        finally:
+            checkpoint_records(self.recordKeeper)
+            self.watcher.close()
+
+
+class FastExitState(object):
+    """Remembers what a finished sweep saw, so that the next run can exit
+    before loading anything when nothing can have become stale. That is the
+    case while the config file, the top level of every tier directory and
+    every directory inside a fresh download are unchanged, no entry is due
+    yet and no filesystem is low on space. Removing a file from a download
+    directory can make it stale sooner, but it changes the directory holding
+    the file. Other changes deeper in a tree only add newer access times"""
+
+    VERSION = 2
+
+    def __init__(self, statePath):
+        self.statePath = statePath
+
+    @staticmethod
+    def modification_times(paths):
+        modificationTimes = {}
+        for path in paths:
+            try:
+                modificationTimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                modificationTimes[path] = None
+        return modificationTimes
+
+    @staticmethod
+    def tree_directories(directoryPaths):
+        """ Returns every directory in the trees of directoryPaths """
+        return [
+            root
+            for directoryPath in directoryPaths
+            for root, dirs, files in os.walk(directoryPath)
+        ]
+
+    @staticmethod
+    def next_due_time(sweeper, configurationManager, recordKeeper):
+        """ Returns the earliest time an entry of an enabled tier becomes stale """
+        dueTimes = []
+        if configurationManager.get_option_value("archive_downloads"):
+            dueTimes.append(sweeper.nextDownloadDueTime)
+
+        for configType, enabledKey in (
+            (ConfigKeyTranslator.ARCHIVES, "purge_archives"),
+            (ConfigKeyTranslator.PURGES, "delete_from_purge"),
+        ):
+            if not configurationManager.get_option_value(enabledKey):
+                continue
+            staleLimit = configurationManager.get_snapshot().staleLimits[
+                ConfigKeyTranslator(configType).stale_limit_key
+            ]
+            earliestRecord = recordKeeper.earliest_record(configType)
+            if earliestRecord is not None:
+                dueTimes.append(earliestRecord + staleLimit.total_seconds())
+
+        dueTimes = [dueTime for dueTime in dueTimes if dueTime is not None]
+        return min(dueTimes) if dueTimes else None
+
+    def save(self, configPath, sweeper, configurationManager, recordKeeper):
+        """ Writes the state after a sweep, or removes it if fast exits are off """
+        if not configurationManager.get_option_value("fast_exit"):
+            try:
+                os.remove(self.statePath)
+            except OSError:
+                pass
+            return
+
+        directoryPaths = [
+            directoryPath
+            for configType in (
+                ConfigKeyTranslator.DOWNLOADS,
+                ConfigKeyTranslator.ARCHIVES,
+                ConfigKeyTranslator.PURGES,
+            )
+            for directoryPath in configurationManager.get_option_value(
+                ConfigKeyTranslator(configType).path_key
+            )
+        ]
+        state = {
+            "version": self.VERSION,
+            "arguments": sys.argv[1:],
+            "modification_times": self.modification_times(
+                [configPath]
+                + directoryPaths
+                + self.tree_directories(sweeper.freshDownloadDirectories)
+            ),
+            "next_due": self.next_due_time(
+                sweeper, configurationManager, recordKeeper
+            ),
+            "evict_on_disk_pressure": configurationManager.get_option_value(
+                "evict_on_disk_pressure"
+            ),
+            "free_space_low_watermark": configurationManager.get_option_value(
+                "free_space_low_watermark"
+            ),
+            "metrics_textfile": configurationManager.get_option_value(
+                "metrics_textfile"
+            ),
+            "metrics_json": configurationManager.get_option_value("metrics_json"),
+        }
+
+        assert_dir_exists(os.path.dirname(os.path.abspath(self.statePath)))
+        temporaryPath = "{}.{}.tmp".format(self.statePath, os.getpid())
+        with open(temporaryPath, "w+") as stateFile:
+            json.dump(state, stateFile)
+        os.replace(temporaryPath, self.statePath)
+
+    def load(self):
+        try:
+            with open(self.statePath, "r") as stateFile:
+                state = json.load(stateFile)
+        except (OSError, ValueError):
+            return None
+        return state if state.get("version") == self.VERSION else None
+
+    def can_exit(self):
+        """ Whether a sweep now would find nothing to do. Returns the saved
+        state if so, and None otherwise """
+        state = self.load()
+        if state is None or state["arguments"] != sys.argv[1:]:
+            return None
+        if state["next_due"] is not None and time.time() >= state["next_due"]:
+            return None
+
+        savedTimes = state["modification_times"]
+        if self.modification_times(savedTimes) != savedTimes:
+            return None
+
+        if state["evict_on_disk_pressure"]:
+            for directoryPath in savedTimes:
+                try:
+                    freeBytes, totalBytes = free_space(directoryPath)
+                    lowWatermark = ConfigFileSizeParser.bytes_from_config_str(
+                        state["free_space_low_watermark"], totalBytes
+                    )
+                except (OSError, ConfigFileSizeParser.InvalidConfigSizeStrException):
+                    return None
+                if freeBytes < lowWatermark:
+                    return None
+
+        return state
+
+
+def restore_from_index(path, restoreTo=None):
+    """Restores the archived file or directory that was at path, to where it
+    was or into restoreTo. Where a file was archived more than once, the copy
+    in the first archive by path is used. Returns whether all of it was
+    restored"""
+    path = os.path.abspath(path)
+    archives, restoredOriginals, copiedPrefixes = {}, set(), []
+    for originalPath, size, archivePath, member, hexDigest in ARCHIVE_INDEX.find(
+        path
+    ):
+        if originalPath in restoredOriginals or any(
+            originalPath.startswith(prefix + os.sep) for prefix in copiedPrefixes
+        ):
+            continue  # Restored already, by itself or with its directory
+        restoredOriginals.add(originalPath)
+        if not member:
+            copiedPrefixes.append(originalPath)
+
+        restoredPath = originalPath
+        if restoreTo is not None:
+            restoredPath = os.path.join(
+                restoreTo, os.path.relpath(originalPath, os.path.dirname(path))
+            )
+        archives.setdefault(archivePath, {})[member] = restoredPath
+
+    if not archives:
+        print("Nothing archived from {} is in the archive index".format(path))
+        return False
+
+    failures = 0
+    for archivePath, restoredPaths in sorted(archives.items()):
+        try:
+            failures += restore_archived(
+                archivePath, restoredPaths, ARCHIVE_INDEX.holds_tarball(archivePath)
+            )
+        except Exception as exception:
+            failures += len(restoredPaths)
+            print("Error restoring from {0}: {1}".format(archivePath, exception))
+            continue
+    return not failures
+
+
+def search_archives(parsed_args):
+    """Runs --find or --restore against the archive index. Returns whether
+    anything was found, or everything was restored"""
+    if not os.path.isfile(parsed_args.archive_index):
+        print("There is no archive index at {}".format(parsed_args.archive_index))
+        return False
+
+    ARCHIVE_INDEX.open(parsed_args.archive_index)
+    try:
+        if parsed_args.restore is not None:
+            return restore_from_index(parsed_args.restore, parsed_args.restore_to)
+
+        rows = ARCHIVE_INDEX.find(parsed_args.find)
+        for originalPath, size, archivePath, member, hexDigest in rows:
+            print(
+                "{0}\t{1}\t{2}\t{3}".format(
+                    originalPath,
+                    "-" if size is None else size,
+                    archivePath,
+                    member or "-",
+                )
+            )
+        return bool(rows)
+    finally:
+        ARCHIVE_INDEX.close()
+
+
+def run_command(parsed_args, configMgr):
+    sweeperObj = Sweeper(configMgr)
+    records = create_record_keeper(configMgr, parsed_args)
+    with METRICS.phase("load_records"):
+        records.load_existing_records(readOnly=parsed_args.dry_run is not None)
+
+    if parsed_args.dry_run is not None:
+        with METRICS.phase("plan"):
+            plan = SweepPlanner(sweeperObj, configMgr, records).plan_sweep()
+        plan.save(parsed_args.dry_run)
+        return
+
+    if configMgr.get_option_value("index_archives"):
+        ARCHIVE_INDEX.open(parsed_args.archive_index)
+
+    journalEntries = OperationJournal.read(parsed_args.journal)
+    with METRICS.phase("replay_journal"):
+        replay_journal(journalEntries, records)
+    JOURNAL.open(parsed_args.journal)
+    if journalEntries:
+        with METRICS.phase("write_records"):
+            checkpoint_records(records)
+
+    if parsed_args.apply_plan is not None:
+        apply_plan(
+            SweepPlan.load(parsed_args.apply_plan),
+            configMgr,
+            records,
+            recheckStaleness=True,
+        )
+        with METRICS.phase("write_records"):
+            checkpoint_records(records)
+        return
+
+    if parsed_args.daemon:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        SweepDaemon(sweeperObj, configMgr, records, create_watcher(configMgr)).run()
+        return
+
+    run_sweep(sweeperObj, configMgr, records)
+    with METRICS.phase("write_records"):
+        checkpoint_records(records)
+    FastExitState(parsed_args.state).save(
+        parsed_args.config, sweeperObj, configMgr, records
+    )
+
+
+NOBODY_UID = 65534
+
+
+def discover_users(minUid):
+    """Returns [(user, configDirectory)] for every user at or above minUid
+    with a download-sweeper configuration, in uid order"""
+    import pwd
+
+    users, seenNames = [], set()
+    for user in sorted(pwd.getpwall(), key=lambda user: user.pw_uid):
+        if user.pw_uid < minUid or user.pw_uid == NOBODY_UID:
+            continue
+        if user.pw_name in seenNames:
+            continue
+        seenNames.add(user.pw_name)
+
+        configDirectory = os.path.join(user.pw_dir, ".config", "download-sweeper")
+        if os.path.isfile(os.path.join(configDirectory, "config.yaml")):
+            users.append((user, configDirectory))
+
+    return users
+
+
+SWEEP_MODULES = (
+    "bz2",
+    "concurrent.futures",
+    "gzip",
+    "hashlib",
+    "lzma",
+    "shutil",
+    "sqlite3",
+    "tarfile",
+    "tempfile",
+    "yaml",
+    "zipfile",
+)
+
+
+def preload_sweep_modules():
+    """Imports the modules a sweep otherwise imports lazily, while the files
+    of the interpreter are still readable even if only root can read them"""
+    import importlib
+
+    for moduleName in SWEEP_MODULES:
+        importlib.import_module(moduleName)
+    import_zstandard()
+
+
+def drop_privileges(user):
+    """ Switches the process to the user, their groups and their environment """
+    if os.geteuid() != user.pw_uid:
+        os.initgroups(user.pw_name, user.pw_gid)
+        os.setgid(user.pw_gid)
+        os.setuid(user.pw_uid)
+    os.environ.update(HOME=user.pw_dir, USER=user.pw_name, LOGNAME=user.pw_name)
+    os.chdir(user.pw_dir)
+
+
+def sweep_user(
+    user, configDirectory, parsed_args, workerShare, ioShares, resultConnection
+):
+    """Sweeps as one user, in a process of its own so that the dropped
+    privileges die with it, and sends back the outcome and metrics"""
+    result = {"user": user.pw_name, "succeeded": False, "error": None}
+    try:
+        preload_sweep_modules()
+        drop_privileges(user)
+        userArgs = argparse.Namespace(**vars(parsed_args))
+        userArgs.system = False
+        userArgs.profile = None
+        userArgs.config = os.path.join(configDirectory, "config.yaml")
+        userArgs.records = os.path.join(configDirectory, "records.yaml")
+        userArgs.records_db = os.path.join(configDirectory, "records.db")
+        userArgs.state = os.path.join(configDirectory, "state.json")
+        userArgs.archive_index = os.path.join(configDirectory, "archive-index.db")
+        userArgs.journal = os.path.join(configDirectory, "journal.jsonl")
+        for key in ("metrics_textfile", "metrics_json"):
+            # The combined metrics are the system run's, the user's own go
+            # wherever their configuration says
+            if hasattr(userArgs, key):
+                delattr(userArgs, key)
+
+        sweep_from_args(userArgs, workerShare, ioShares)
+        result["succeeded"] = True
+    except BaseException as exception:
+        result["error"] = "{}: {}".format(type(exception).__name__, exception)
+
+    result["metrics"] = METRICS.to_dict()
+    resultConnection.send(result)
+    resultConnection.close()
+
+
+def sweep_all_users(parsed_args):
+    """Sweeps every discovered user in one pass, running at most
+    system_workers of them at once and splitting the CPUs between their
+    compression pools and the I/O budget between them. Prints a combined
+    summary and exports the combined metrics.
+
+    Return:
+    True if every user was swept successfully
+    """
+    from multiprocessing import Pipe, Process
+    from multiprocessing.connection import wait
+
+    users = discover_users(parsed_args.system_min_uid)
+    workers = max(1, min(parsed_args.system_workers, len(users)))
+    workerShare = max(1, (os.cpu_count() or 1) // workers)
+
+    pendingUsers, runningUsers, results = list(users), {}, []
+    while pendingUsers or runningUsers:
+        while pendingUsers and len(runningUsers) < workers:
+            user, configDirectory = pendingUsers.pop(0)
+            receiveConnection, sendConnection = Pipe(duplex=False)
+            process = Process(
+                target=sweep_user,
+                args=(
+                    user,
+                    configDirectory,
+                    parsed_args,
+                    workerShare,
+                    workers,
+                    sendConnection,
+                ),
+            )
+            process.start()
+            sendConnection.close()
+            runningUsers[process.sentinel] = (process, user, receiveConnection)
+
+        for sentinel in wait(list(runningUsers)):
+            process, user, receiveConnection = runningUsers.pop(sentinel)
+            process.join()
+            if receiveConnection.poll():
+                results.append(receiveConnection.recv())
+            else:
+                results.append(
+                    {
+                        "user": user.pw_name,
+                        "succeeded": False,
+                        "error": "Exited with code {}".format(process.exitcode),
+                        "metrics": None,
+                    }
+                )
+            receiveConnection.close()
+
+    METRICS.reset()
+    for result in sorted(results, key=lambda result: result["user"]):
+        if result["metrics"] is not None:
+            METRICS.merge(result["metrics"])
+        print(summarize_user_sweep(result))
+
+    succeeded = all(result["succeeded"] for result in results)
+    METRICS.finish(succeeded)
+    print(
+        "Swept {0} users, {1} failed: {2} bytes moved, {3} bytes deleted, "
+        "{4} errors".format(
+            len(results),
+            sum(not result["succeeded"] for result in results),
+            METRICS.counters["bytes_moved"],
+            METRICS.counters["bytes_deleted"],
+            METRICS.counters["errors"],
+        )
+    )
+    METRICS.export_to(
+        getattr(parsed_args, "metrics_textfile", None),
+        getattr(parsed_args, "metrics_json", None),
+    )
+    return succeeded
+
+
+def summarize_user_sweep(result):
+    if not result["succeeded"]:
+        return "{0}: failed, {1}".format(result["user"], result["error"])
+
+    metrics = result["metrics"]
+    return "{0}: swept in {1:.2f}s, {2} bytes moved, {3} deleted, {4} errors".format(
+        result["user"],
+        metrics["run_seconds"],
+        metrics["counters"]["bytes_moved"],
+        metrics["counters"]["deletions"],
+        metrics["counters"]["errors"],
+    )
+
+
+def sweep_from_args(parsed_args, workerShare=None, ioShares=1):
+    """Runs what the arguments ask for and exports its metrics. workerShare
+    caps the compression processes when several users are swept at once, and
+    the I/O budget is split into ioShares for them"""
+    if (
+        not parsed_args.daemon
+        and parsed_args.dry_run is None
+        and parsed_args.apply_plan is None
+    ):
+        fastExitState = FastExitState(parsed_args.state).can_exit()
+        if fastExitState is not None and OperationJournal.is_empty(
+            parsed_args.journal
+        ):
+            METRICS.finish(True)
+            METRICS.export_to(
+                fastExitState["metrics_textfile"], fastExitState["metrics_json"]
+            )
+            return
+
+    configMgr = ConfigurationManager(parsed_args.config, parsed_args)
+    THROTTLE.configure(configMgr)
+    if ioShares > 1:
+        THROTTLE.apply_settings(THROTTLE.shared_settings(ioShares))
+    if workerShare is not None:
+        compressionWorkers = configMgr.get_option_value("compression_workers")
+        if not compressionWorkers or compressionWorkers > workerShare:
+            parsed_args.compression_workers = workerShare
+            configMgr.load_config_file()
+    METRICS.reset()
+
+    profiler = None
+    if parsed_args.profile is not None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    succeeded = False
+    try:
+        run_command(parsed_args, configMgr)
+        succeeded = True
+    except SystemExit as exitException:
+        succeeded = not exitException.code  # The daemon exits 0 on SIGTERM
+        raise
+    finally:
+        JOURNAL.close()
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(parsed_args.profile)
+        METRICS.finish(succeeded)
+        METRICS.export(configMgr)
+
+
+def main():
+    # Parse the arguments
+    parsed_args = argParser.parse_args()
+    if parsed_args.find is not None or parsed_args.restore is not None:
+        if (
+            parsed_args.system
+            or parsed_args.daemon
+            or parsed_args.dry_run is not None
+            or parsed_args.apply_plan is not None
+        ):
+            argParser.error("--find and --restore only read the archive index")
+        sys.exit(0 if search_archives(parsed_args) else 1)
+
+    if parsed_args.system:
+        if (
+            parsed_args.daemon
+            or parsed_args.dry_run is not None
+            or parsed_args.apply_plan is not None
+        ):
+            argParser.error("--system only runs one-shot sweeps")
+        sys.exit(0 if sweep_all_users(parsed_args) else 1)
+
+    sweep_from_args(parsed_args)
 
 
 if __name__ == "__main__":